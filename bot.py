@@ -1,10 +1,35 @@
+import argparse
+import asyncio
+import cProfile
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import pstats
+import random
+import re
+import signal
 import sqlite3
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from types import SimpleNamespace
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+try:
+    from PIL import Image  # opcional: hash perceptual de media
+except ImportError:
+    Image = None
+
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -12,23 +37,43 @@ from telegram import (
     ChatPermissions,
 )
 from telegram.constants import ChatType
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
 # -------------------- CONFIG --------------------
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-if not TOKEN:
-    raise RuntimeError("Falta TELEGRAM_BOT_TOKEN. Ponlo en .env o como variable de entorno.")
-BOT_USERNAME = "TecsoPro"  # opcional (sin @)
+# multi-bot: varios tokens separados por coma, en un solo proceso (comparten DB y caches)
+TOKENS = [t.strip() for t in os.getenv("TELEGRAM_BOT_TOKENS", "").split(",") if t.strip()] or ([TOKEN] if TOKEN else [])
+BOT_USERNAME = "TecsoPro"  # opcional (sin @); si no, se usa el username de cada bot
 
 DB_PATH = "bot.db"
 
+# archivo mensual de auditoría (warns/bans/unbans antiguos)
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_INTERVAL_SECONDS = 6 * 60 * 60
+
+# estadísticas (rollups por hora)
+STATS_RETENTION_DAYS = 35
+STATS_HOUR_FMT = "%Y-%m-%dT%H"
+STATS_WINDOWS = {"24h": 24, "7d": 7 * 24, "30d": 30 * 24}
+
+# paginación de historial
+WARNS_PAGE_SIZE = 10
+HISTORY_PAGE_SIZE = 15
+HISTORY_SCOPE_TTL = 300  # segundos que se reutilizan los chats visibles de un /history al paginar
+HISTORY_SCOPE_MAX = 2_000
+HISTORY_SCAN_COOLDOWN = 15  # segundos entre escaneos nuevos (sin cache) de /history por usuario
+
 MIN_WARN_LIMIT = 1
 MAX_WARN_LIMIT = 20
 MAX_MUTE_MINUTES = 7 * 24 * 60  # 7 días
@@ -41,9 +86,117 @@ STATE_NONE = None
 STATE_ADD_BW = "await_add_banned_word"
 STATE_REMOVE_BW = "await_remove_banned_word"
 
+# menú /config
+ADMIN_CACHE_TTL = 60  # segundos que se confía en un get_chat_member
+ADMIN_CACHE_MAX = 50_000
+MENU_DEBOUNCE_SECONDS = 0.6
+MENU_RENDER_CACHE_SIZE = 2_000
+
+# sanciones temporales (tempban / mute)
+SCHEDULER_KEY = "sanction_scheduler"
+SCHEDULER_MAX_SLEEP = 300  # re-evalúa al menos cada 5 min (cambios de reloj)
+SANCTION_RETRY_SECONDS = 60   # primer reintento si falla el unban; luego se duplica
+SANCTION_RETRY_MAX = 6        # intentos antes de cerrar la sanción sin levantarla
+MAX_TBAN_SECONDS = 365 * 24 * 60 * 60
+DURATION_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+SANCTIONS_LIST_LIMIT = 30
+
+# límites del Bot API (por bot)
+API_GLOBAL_RATE = 30  # requests/segundo
+
+# media blocklist (hash perceptual solo si Pillow está instalado)
+MEDIA_PHASH_MAX_DISTANCE = 6  # bits distintos de 64
+PHASH_CACHE_SIZE = 20_000
+
+# ingesta: mensajes recordados para detectar ediciones sin cambios
+SEEN_TEXT_CACHE_SIZE = 50_000
+
+# modo degradado (backpressure): entra con los umbrales altos, sale con los bajos
+LOAD_BACKLOG_HIGH = 200       # updates en cola
+LOAD_BACKLOG_LOW = 20
+LOAD_LATENCY_HIGH = 1.5       # segundos por update (EWMA)
+LOAD_LATENCY_LOW = 0.3
+LOAD_RECOVERY_SECONDS = 30
+LOAD_CHECK_SECONDS = 1
+LOAD_FLUSH_SECONDS = 60       # stats diferidas se escriben al menos cada minuto
+LOAD_EWMA_ALPHA = 0.2
+LOAD_ALERT_CHAT_ID = os.getenv("LOAD_ALERT_CHAT_ID")  # opcional; si no, todos los mod-logs
+
+# grabación de tráfico (opcional) para replay offline
+RECORD_PATH = os.getenv("RECORD_PATH")            # ej: traffic.jsonl.gz
+RECORD_HASH_TEXT = os.getenv("RECORD_HASH_TEXT") == "1"
+RECORD_SALT = os.getenv("RECORD_SALT", "")
+RECORD_FLUSH_SECONDS = 30     # cada flush cierra el miembro gzip: un kill pierde como mucho esto
+
+# avisos en el chat: uno por ventana, editado en el sitio y borrado tras el TTL
+NOTICES_KEY = "notices"
+NOTICE_WINDOW_SECONDS = 30
+NOTICE_EDIT_INTERVAL = 2
+NOTICE_TTL_SECONDS = 60       # por defecto; cada chat puede cambiarlo con /noticettl
+NOTICE_TTL_MAX = 47 * 60 * 60  # Telegram solo deja borrar mensajes de < 48 h
+NOTICE_SWEEP_SECONDS = 5
+DELETE_BATCH_SIZE = 100       # máximo de deleteMessages
+
+# confianza por (chat, usuario): los miembros establecidos pueden saltarse filtros caros
+TRUST_CACHE_SIZE = 100_000
+TRUST_FLUSH_SECONDS = 60
+TRUST_FULL_MESSAGES = 500     # mensajes limpios para la mitad "actividad" del score
+TRUST_FULL_DAYS = 30          # antigüedad para la mitad "tenure" del score
+TRUST_WARN_PENALTY = 25       # puntos por warn
+TRUST_WARN_COOLDOWN_DAYS = 30  # un warn reciente deja el score en 0
+TRUST_THRESHOLD = 70          # score (0-100) a partir del cual es "confiable"
+MANDATORY_FILTERS = frozenset({"banned_words"})  # nunca se saltan
+
+# mensajes recientes por chat (para /purge y revisión retroactiva de banned words)
+RECENT_PER_CHAT = 2_000
+RECENT_CHATS_MAX = 5_000
+RECENT_MAX_AGE = 47 * 60 * 60  # Telegram solo deja borrar mensajes de < 48 h
+RETRO_SCAN_MINUTES = 10
+
+# heurísticas de caracteres (scripts, emoji, invisibles, links, mayúsculas)
+HEURISTIC_ACTIONS = ("off", "log", "delete", "warn")
+HEURISTIC_DEFAULTS = {        # umbrales si el chat no los cambió; "off" desactiva uno
+    "foreign": 0.5,           # fracción de letras fuera de los scripts permitidos
+    "emoji": 0.6,             # fracción de emoji sobre caracteres visibles
+    "invisible": 10,          # cantidad de caracteres invisibles (zero-width, bidi, rellenos)
+    "links": 5.0,             # links cada 100 caracteres visibles
+    "upper": 0.8,             # fracción de mayúsculas sobre letras con caja
+}
+HEURISTIC_SCRIPTS_DEFAULT = "latin"
+HEURISTIC_MIN_CHARS = 20      # las proporciones solo cuentan en mensajes con al menos esto visible
+
+# clasificador de spam (Naive Bayes incremental sobre uni/bigramas hasheados)
+CLF_BUCKETS = 1 << 15         # features por modelo (2 × array('I') = 256 KB)
+CLF_MAX_TOKENS = 200          # tokens por mensaje que se miran (≤ 400 features)
+CLF_MIN_DOCS = 20             # ejemplos mínimos de cada clase antes de puntuar
+CLF_MODELS_MAX = 200          # modelos en memoria (LRU)
+CLF_FLUSH_SECONDS = 120
+CLF_EXAMPLES_MAX = 20_000     # ejemplos guardados por modelo (para evalclf)
+CLF_HAM_SAMPLE = 0.05         # fracción de mensajes limpios de miembros confiables usados como ham
+CLF_SHARED_MODEL = 0
+CLF_DEFAULTS = {"action": "off", "model": "chat", "flag": 0.9, "warn": 0.99}
+
+# índice @username -> user_id y última vez visto por chat (para comandos sin reply)
+USER_NAMES_MAX = 200_000
+USER_SEEN_MAX = 500_000
+USER_SEEN_RESOLUTION = 300    # segundos: last_seen solo se vuelve a guardar si cambió más que esto
+USER_INDEX_FLUSH_SECONDS = 60
+MIN_USER_ID = 100_000         # un número menor como primer argumento es minutos/duración, no un user_id
+
+# profiling de updates lentos (opt-in): PROFILE_SLOW_MS activa el modo
+PROFILE_SLOW_MS = int(os.getenv("PROFILE_SLOW_MS") or 0)      # umbral para guardar reporte
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)  # 0-1: updates muestreados aunque sean rápidos
+PROFILE_CPROFILE = os.getenv("PROFILE_CPROFILE") == "1"       # stack completo (solo en los muestreados)
+PROFILE_DIR = "profiles"
+PROFILE_MAX_REPORTS = 200     # anillo en disco: se borran los más viejos
+PROFILE_STACK_LINES = 25
+SLOW_TOP = 10
+
 
 # -------------------- DB CONNECTION --------------------
 def db() -> sqlite3.Connection:
+    if CURRENT_PROFILE.get() is not None:
+        return profiled_connect(DB_PATH, sys._getframe(1).f_code.co_name)
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
@@ -74,12 +227,21 @@ def init_db():
     conn = db()
     cur = conn.cursor()
 
+    # auto_vacuum incremental: en DBs viejas solo aplica tras un VACUUM (una vez)
+    if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cur.execute("VACUUM")
+
     # chats config por grupo
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chats (
         chat_id INTEGER PRIMARY KEY,
         warn_limit INTEGER NOT NULL DEFAULT 3,
-        log_chat_id INTEGER
+        log_chat_id INTEGER,
+        notice_ttl INTEGER,
+        trust_policy TEXT,
+        heuristics TEXT,
+        classifier TEXT
     )
     """)
 
@@ -131,13 +293,121 @@ def init_db():
     )
     """)
 
+    # media bloqueada por grupo (file_unique_id + hash perceptual opcional)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS media_blocklist (
+        chat_id INTEGER NOT NULL,
+        file_unique_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        phash INTEGER,               -- dHash 64 bits (con signo)
+        created_by INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (chat_id, file_unique_id)
+    ) WITHOUT ROWID
+    """)
+
+    # sanciones con expiración (tempban / mute); active=0 cuando expira o se revoca
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sanctions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,          -- ban | mute
+        created_by INTEGER NOT NULL DEFAULT 0,
+        reason TEXT,
+        created_at TEXT NOT NULL,
+        expires_at REAL NOT NULL,    -- epoch UTC
+        active INTEGER NOT NULL DEFAULT 1,
+        ended_at TEXT,
+        bot_id INTEGER               -- bot que la aplicó (y que la levanta); NULL = anterior a multi-bot
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sanctions_active ON sanctions(active, expires_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sanctions_chat ON sanctions(chat_id, active, expires_at)")
+
+    # confianza por miembro (se escribe por lotes desde memoria)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS member_trust (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        messages INTEGER NOT NULL DEFAULT 0,   -- mensajes limpios
+        first_seen REAL NOT NULL,              -- epoch UTC
+        warns INTEGER NOT NULL DEFAULT 0,
+        last_warn_at REAL,                     -- epoch UTC
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+    # clasificador Naive Bayes: contadores por bucket de features hasheadas (array('I') en BLOB)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS classifier_models (
+        model_id INTEGER PRIMARY KEY,          -- chat_id, o 0 = modelo compartido
+        ham_docs INTEGER NOT NULL DEFAULT 0,
+        spam_docs INTEGER NOT NULL DEFAULT 0,
+        ham_tokens INTEGER NOT NULL DEFAULT 0,
+        spam_tokens INTEGER NOT NULL DEFAULT 0,
+        ham BLOB NOT NULL,
+        spam BLOB NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    """)
+    # ejemplos etiquetados (solo features hasheadas, nunca el texto) para `python bot.py evalclf`
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS classifier_examples (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        model_id INTEGER NOT NULL,
+        spam INTEGER NOT NULL,
+        features BLOB NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_classifier_examples_model ON classifier_examples(model_id, id)")
+
+    # índice de usuarios (se escribe por lotes desde memoria)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_names (
+        username TEXT PRIMARY KEY,   -- en minúsculas, sin @
+        user_id INTEGER NOT NULL,
+        updated_at REAL NOT NULL     -- epoch UTC (última vez que se vio al usuario con ese @)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_names_user ON user_names(user_id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_last_seen (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        last_seen REAL NOT NULL,     -- epoch UTC
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+    # estadísticas: contadores por hora (se actualizan con cada evento)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats_hourly (
+        chat_id INTEGER NOT NULL,
+        hour TEXT NOT NULL,        -- YYYY-MM-DDTHH (UTC)
+        metric TEXT NOT NULL,      -- warn | ban | unban | mute | bw_hit | offender
+        key TEXT NOT NULL DEFAULT '',
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, hour, metric, key)
+    ) WITHOUT ROWID
+    """)
+
     # MIGRATIONS (si DB vieja)
     if table_exists(conn, "chats"):
         ensure_columns(conn, "chats", {
             "warn_limit": "INTEGER NOT NULL DEFAULT 3",
             "log_chat_id": "INTEGER",
+            "notice_ttl": "INTEGER",
+            "trust_policy": "TEXT",
+            "heuristics": "TEXT",
+            "classifier": "TEXT",
         })
 
+    if table_exists(conn, "sanctions"):
+        ensure_columns(conn, "sanctions", {"bot_id": "INTEGER"})
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sanctions_bot ON sanctions(bot_id, active)")
+
     if table_exists(conn, "warns"):
         ensure_columns(conn, "warns", {
             "warned_by": "INTEGER NOT NULL DEFAULT 0",
@@ -172,6 +442,12 @@ def init_db():
         })
         cur.execute("UPDATE banned_words SET created_at = COALESCE(created_at, ?)", (datetime.now(timezone.utc).isoformat(),))
 
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_banned_words_chat ON banned_words(chat_id, word)")
+
+    # índices de auditoría (archivo por fecha, paginación por chat/usuario)
+    for name, t, cols in AUDIT_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {t}({cols})")
+
     conn.commit()
     conn.close()
 
@@ -185,14 +461,46 @@ def ensure_chat(chat_id: int):
     conn.close()
 
 
+# caches compartidos por todos los bots del proceso; se invalidan en cada escritura
+SETTINGS_CACHE: dict[int, sqlite3.Row] = {}
+BW_MATCHERS: dict[int, Optional[re.Pattern]] = {}
+
+
+TRUST_POLICIES: dict[int, dict[str, int]] = {}
+HEURISTIC_CONFIGS: dict[int, dict] = {}
+CLASSIFIER_CONFIGS: dict[int, dict] = {}
+
+
+def invalidate_chat_cache(chat_id: int):
+    SETTINGS_CACHE.pop(chat_id, None)
+    BW_MATCHERS.pop(chat_id, None)
+    TRUST_POLICIES.pop(chat_id, None)
+    HEURISTIC_CONFIGS.pop(chat_id, None)
+    CLASSIFIER_CONFIGS.pop(chat_id, None)
+
+
 def get_warn_limit(chat_id: int) -> int:
-    ensure_chat(chat_id)
+    return int(get_chat_settings(chat_id)["warn_limit"])
+
+
+def get_chat_settings(chat_id: int) -> sqlite3.Row:
+    """Snapshot de la config del chat en una sola lectura (incluye COUNT de banned words)."""
+    cached = SETTINGS_CACHE.get(chat_id)
+    if cached is not None:
+        return cached
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT warn_limit FROM chats WHERE chat_id = ?", (chat_id,))
+    cur.execute("INSERT OR IGNORE INTO chats(chat_id) VALUES (?)", (chat_id,))
+    cur.execute("""
+        SELECT warn_limit, log_chat_id, notice_ttl, trust_policy, heuristics, classifier,
+               (SELECT COUNT(*) FROM banned_words WHERE chat_id = chats.chat_id) AS bw_count
+        FROM chats WHERE chat_id = ?
+    """, (chat_id,))
     row = cur.fetchone()
+    conn.commit()
     conn.close()
-    return int(row["warn_limit"])
+    SETTINGS_CACHE[chat_id] = row
+    return row
 
 
 def set_warn_limit(chat_id: int, limit: int):
@@ -202,17 +510,249 @@ def set_warn_limit(chat_id: int, limit: int):
     cur.execute("UPDATE chats SET warn_limit = ? WHERE chat_id = ?", (limit, chat_id))
     conn.commit()
     conn.close()
+    invalidate_chat_cache(chat_id)
 
 
 def get_log_chat_id(chat_id: int) -> Optional[int]:
+    val = get_chat_settings(chat_id)["log_chat_id"]
+    return int(val) if val is not None else None
+
+
+def get_notice_ttl(chat_id: int) -> int:
+    val = get_chat_settings(chat_id)["notice_ttl"]
+    return int(val) if val is not None else NOTICE_TTL_SECONDS
+
+
+def set_notice_ttl(chat_id: int, ttl: int):
+    ensure_chat(chat_id)
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE chats SET notice_ttl = ? WHERE chat_id = ?", (ttl, chat_id))
+    conn.commit()
+    conn.close()
+    invalidate_chat_cache(chat_id)
+
+
+def get_trust_policy(chat_id: int) -> dict[str, int]:
+    """filtro -> % de mensajes de miembros confiables que sí se inspeccionan (0 = se salta)."""
+    policy = TRUST_POLICIES.get(chat_id)
+    if policy is None:
+        raw = get_chat_settings(chat_id)["trust_policy"] or ""
+        policy = {}
+        for part in raw.split(","):
+            name, _, pct = part.partition(":")
+            if name and pct.isdigit():
+                policy[name] = int(pct)
+        TRUST_POLICIES[chat_id] = policy
+    return policy
+
+
+def set_trust_policy(chat_id: int, policy: dict[str, int]):
+    ensure_chat(chat_id)
+    raw = ",".join(f"{name}:{pct}" for name, pct in sorted(policy.items())) or None
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE chats SET trust_policy = ? WHERE chat_id = ?", (raw, chat_id))
+    conn.commit()
+    conn.close()
+    invalidate_chat_cache(chat_id)
+
+
+# columnas de chats con opciones "k=v;k=v" (heurísticas, clasificador)
+OPTION_COLUMNS = ("heuristics", "classifier")
+
+
+def chat_options(chat_id: int, column: str) -> dict[str, str]:
+    raw = get_chat_settings(chat_id)[column] or ""
+    return dict(part.split("=", 1) for part in raw.split(";") if "=" in part)
+
+
+def set_chat_option(chat_id: int, column: str, key: str, value: Optional[str]):
+    """Cambia una opción conservando las demás (value=None la quita)."""
+    if column not in OPTION_COLUMNS:
+        raise ValueError(f"columna de opciones desconocida: {column}")
+    opts = chat_options(chat_id, column)
+    if value is None:
+        opts.pop(key, None)
+    else:
+        opts[key] = value
+    ensure_chat(chat_id)
+    conn = db()
+    cur = conn.cursor()
+    cur.execute(
+        f"UPDATE chats SET {column} = ? WHERE chat_id = ?",
+        (";".join(f"{k}={v}" for k, v in sorted(opts.items())) or None, chat_id),
+    )
+    conn.commit()
+    conn.close()
+    invalidate_chat_cache(chat_id)
+
+
+def reset_chat_options(chat_id: int, column: str):
+    if column not in OPTION_COLUMNS:
+        raise ValueError(f"columna de opciones desconocida: {column}")
     ensure_chat(chat_id)
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT log_chat_id FROM chats WHERE chat_id = ?", (chat_id,))
+    cur.execute(f"UPDATE chats SET {column} = NULL WHERE chat_id = ?", (chat_id,))
+    conn.commit()
+    conn.close()
+    invalidate_chat_cache(chat_id)
+
+
+def get_heuristics_config(chat_id: int) -> dict:
+    """{"action", "scripts": frozenset, umbral por métrica (None = desactivada)}."""
+    config = HEURISTIC_CONFIGS.get(chat_id)
+    if config is None:
+        raw = chat_options(chat_id, "heuristics")
+        config = {
+            "action": raw.get("action", "off"),
+            "scripts": frozenset(filter(None, raw.get("scripts", HEURISTIC_SCRIPTS_DEFAULT).split(","))),
+        }
+        for metric, default in HEURISTIC_DEFAULTS.items():
+            val = raw.get(metric)
+            config[metric] = None if val == "off" else (float(val) if val else default)
+        HEURISTIC_CONFIGS[chat_id] = config
+    return config
+
+
+def get_classifier_config(chat_id: int) -> dict:
+    """{"action": off|log|warn, "model": chat|shared, "flag": p, "warn": p}."""
+    config = CLASSIFIER_CONFIGS.get(chat_id)
+    if config is None:
+        raw = chat_options(chat_id, "classifier")
+        config = {
+            "action": raw.get("action", CLF_DEFAULTS["action"]),
+            "model": raw.get("model", CLF_DEFAULTS["model"]),
+            "flag": float(raw.get("flag", CLF_DEFAULTS["flag"])),
+            "warn": float(raw.get("warn", CLF_DEFAULTS["warn"])),
+        }
+        CLASSIFIER_CONFIGS[chat_id] = config
+    return config
+
+
+def load_classifier_model(model_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT ham_docs, spam_docs, ham_tokens, spam_tokens, ham, spam FROM classifier_models WHERE model_id = ?
+    """, (model_id,))
     row = cur.fetchone()
     conn.close()
-    val = row["log_chat_id"]
-    return int(val) if val is not None else None
+    return row
+
+
+def save_classifier(models: list[tuple], examples: list[tuple]):
+    """
+    models: (model_id, ham_docs, spam_docs, ham_tokens, spam_tokens, ham, spam) con BLOBs.
+    examples: (model_id, spam, features, created_at). Todo en un commit; recorta los ejemplos viejos.
+    """
+    conn = db()
+    cur = conn.cursor()
+    cur.executemany("""
+        INSERT INTO classifier_models(model_id, ham_docs, spam_docs, ham_tokens, spam_tokens, ham, spam, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(model_id) DO UPDATE SET
+            ham_docs = excluded.ham_docs, spam_docs = excluded.spam_docs,
+            ham_tokens = excluded.ham_tokens, spam_tokens = excluded.spam_tokens,
+            ham = excluded.ham, spam = excluded.spam, updated_at = excluded.updated_at
+    """, [m + (datetime.now(timezone.utc).isoformat(),) for m in models])
+    cur.executemany("""
+        INSERT INTO classifier_examples(model_id, spam, features, created_at) VALUES (?, ?, ?, ?)
+    """, examples)
+    for model_id in {e[0] for e in examples}:
+        cur.execute("""
+            DELETE FROM classifier_examples WHERE model_id = ? AND id <= (
+                SELECT id FROM classifier_examples WHERE model_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+            )
+        """, (model_id, model_id, CLF_EXAMPLES_MAX))
+    conn.commit()
+    conn.close()
+
+
+def load_classifier_examples(model_id: Optional[int]) -> list[sqlite3.Row]:
+    conn = db()
+    cur = conn.cursor()
+    if model_id is None:
+        cur.execute("SELECT model_id, spam, features FROM classifier_examples ORDER BY id")
+    else:
+        cur.execute("SELECT model_id, spam, features FROM classifier_examples WHERE model_id = ? ORDER BY id", (model_id,))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def load_member_trust(chat_id: int, user_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT messages, first_seen, warns, last_warn_at FROM member_trust
+        WHERE chat_id = ? AND user_id = ?
+    """, (chat_id, user_id))
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+
+def save_member_trust(rows: list[tuple]):
+    """rows: (chat_id, user_id, messages, first_seen, warns, last_warn_at). Un solo commit."""
+    conn = db()
+    conn.executemany("""
+        INSERT INTO member_trust(chat_id, user_id, messages, first_seen, warns, last_warn_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            messages = excluded.messages, warns = excluded.warns, last_warn_at = excluded.last_warn_at
+    """, rows)
+    conn.commit()
+    conn.close()
+
+
+def load_username(username: str) -> Optional[tuple[int, float]]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id, updated_at FROM user_names WHERE username = ?", (username,))
+    row = cur.fetchone()
+    conn.close()
+    return (int(row["user_id"]), row["updated_at"]) if row else None
+
+
+def load_username_of(user_id: int) -> Optional[tuple[str, float]]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT username, updated_at FROM user_names WHERE user_id = ? ORDER BY updated_at DESC LIMIT 1", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    return (row["username"], row["updated_at"]) if row else None
+
+
+def load_last_seen(chat_id: int, user_id: int) -> Optional[float]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT last_seen FROM user_last_seen WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+    row = cur.fetchone()
+    conn.close()
+    return row["last_seen"] if row else None
+
+
+def save_user_index(names: list[tuple], seen: list[tuple], dropped: tuple = ()):
+    """
+    names: (username, user_id, updated_at); seen: (chat_id, user_id, last_seen); dropped: user_ids
+    que ya no tienen @. Cada @ guardado borra los anteriores del mismo usuario. Un solo commit.
+    """
+    conn = db()
+    cur = conn.cursor()
+    cur.executemany("DELETE FROM user_names WHERE user_id = ?", [(uid,) for uid in dropped])
+    cur.executemany("DELETE FROM user_names WHERE user_id = ? AND username <> ?", [(uid, k) for k, uid, _ in names])
+    cur.executemany("""
+        INSERT INTO user_names(username, user_id, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(username) DO UPDATE SET user_id = excluded.user_id, updated_at = excluded.updated_at
+    """, names)
+    cur.executemany("""
+        INSERT INTO user_last_seen(chat_id, user_id, last_seen) VALUES (?, ?, ?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)
+    """, seen)
+    conn.commit()
+    conn.close()
 
 
 def set_log_chat_id(chat_id: int, log_chat_id: Optional[int]):
@@ -222,17 +762,42 @@ def set_log_chat_id(chat_id: int, log_chat_id: Optional[int]):
     cur.execute("UPDATE chats SET log_chat_id = ? WHERE chat_id = ?", (log_chat_id, chat_id))
     conn.commit()
     conn.close()
+    invalidate_chat_cache(chat_id)
+
+
+def stats_bump(cur: sqlite3.Cursor, chat_id: int, metric: str, key: str = "", n: int = 1):
+    """Suma `n` al contador de la hora actual (usa el cursor del llamador: misma transacción)."""
+    hour = datetime.now(timezone.utc).strftime(STATS_HOUR_FMT)
+    cur.execute("""
+        INSERT INTO stats_hourly(chat_id, hour, metric, key, value)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, hour, metric, key) DO UPDATE SET value = value + excluded.value
+    """, (chat_id, hour, metric, key, n))
+
+
+def stats_add(chat_id: int, metric: str, key: str = "", n: int = 1):
+    if LOAD.degraded:
+        # escritura no crítica: se acumula y se escribe en lote al salir del modo degradado
+        return LOAD.defer_stat(chat_id, metric, key, n)
+    conn = db()
+    stats_bump(conn.cursor(), chat_id, metric, key, n)
+    conn.commit()
+    conn.close()
 
 
 def add_warn(chat_id: int, user_id: int, warned_by: int, reason: Optional[str]):
+    TRUST.get(chat_id, user_id)  # si es nuevo, se siembra con los warns previos (sin contar este)
     conn = db()
     cur = conn.cursor()
     cur.execute("""
         INSERT INTO warns(chat_id, user_id, warned_by, reason, created_at)
         VALUES (?, ?, ?, ?, ?)
     """, (chat_id, user_id, warned_by, reason, datetime.now(timezone.utc).isoformat()))
+    stats_bump(cur, chat_id, "warn")
+    stats_bump(cur, chat_id, "offender", str(user_id))
     conn.commit()
     conn.close()
+    TRUST.note_warn(chat_id, user_id)
 
 
 def count_warns(chat_id: int, user_id: int) -> int:
@@ -244,6 +809,16 @@ def count_warns(chat_id: int, user_id: int) -> int:
     return int(row["c"])
 
 
+def warn_summary(chat_id: int, user_id: int) -> tuple[int, Optional[float]]:
+    """(warns, epoch del último warn o None): semilla de la confianza de un miembro nuevo en el tracker."""
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) AS c, MAX(created_at) AS last FROM warns WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+    row = cur.fetchone()
+    conn.close()
+    return int(row["c"]), (datetime.fromisoformat(row["last"]).timestamp() if row["last"] else None)
+
+
 def remove_last_warn(chat_id: int, user_id: int) -> bool:
     conn = db()
     cur = conn.cursor()
@@ -264,6 +839,7 @@ def remove_last_warn(chat_id: int, user_id: int) -> bool:
 
 
 def clear_warns(chat_id: int, user_id: int) -> int:
+    """Borra los warns activos y también los archivados (así /warns y /history quedan vacíos)."""
     conn = db()
     cur = conn.cursor()
     cur.execute("SELECT COUNT(*) AS c FROM warns WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
@@ -271,22 +847,75 @@ def clear_warns(chat_id: int, user_id: int) -> int:
     cur.execute("DELETE FROM warns WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
     conn.commit()
     conn.close()
+    for path in archive_files():
+        conn = sqlite3.connect(path)
+        cur = conn.cursor()
+        cur.execute("DELETE FROM warns WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        count += cur.rowcount
+        conn.commit()
+        conn.close()
     return count
 
 
-def list_warns(chat_id: int, user_id: int, limit: int = 10):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, reason, warned_by, created_at
-        FROM warns
-        WHERE chat_id = ? AND user_id = ?
+def list_warns(chat_id: int, user_id: int, limit: int = 10, before_id: Optional[int] = None):
+    # historial: DB caliente + archivos mensuales; keyset (id < before_id), nunca OFFSET
+    # src: "main" (activo, cuenta para el límite) o "arc" (archivado)
+    return history_query("""
+        SELECT id, reason, warned_by, created_at, '{s}' AS src
+        FROM {s}.warns
+        WHERE chat_id = ? AND user_id = ? AND id < ?
         ORDER BY id DESC
-        LIMIT ?
-    """, (chat_id, user_id, limit))
-    rows = cur.fetchall()
+        LIMIT {limit}
+    """, (chat_id, user_id, before_id if before_id is not None else 2 ** 63 - 1), limit)
+
+
+def history_user_chats(user_id: int) -> set[int]:
+    """Chats donde el usuario tiene registros (warns/bans/unbans), incluyendo archivos."""
+    sql = " UNION ".join(f"SELECT DISTINCT chat_id FROM {{s}}.{t} WHERE user_id = ?" for t in ARCHIVED_TABLES)
+    chats: set[int] = set()
+    conn = history_db()
+    cur = conn.cursor()
+    for schema, path in [("main", None)] + [("arc", p) for p in archive_files()]:
+        if path:
+            cur.execute("ATTACH DATABASE ? AS arc", (f"file:{path}?mode=ro",))
+        try:
+            cur.execute(sql.format(s=schema), (user_id,) * len(ARCHIVED_TABLES))
+            chats.update(int(r["chat_id"]) for r in cur.fetchall())
+        finally:
+            if path:
+                cur.execute("DETACH DATABASE arc")
     conn.close()
-    return rows
+    return chats
+
+
+def list_user_history(user_id: int, chat_ids: list[int], limit: int, cursor: Optional[tuple[str, int, int]] = None):
+    """
+    Warns/bans/unbans de un usuario en `chat_ids`, del más reciente al más antiguo.
+    Orden (created_at, kind, id) DESC; `cursor` es la última fila vista (keyset).
+    """
+    marks = ",".join("?" * len(chat_ids))
+    parts, params = [], []
+    for kind, t in enumerate(ARCHIVED_TABLES):
+        where = f"user_id = ? AND chat_id IN ({marks})"
+        p: list = [user_id, *chat_ids]
+        if cursor:
+            ts, last_kind, last_id = cursor
+            if kind < last_kind:
+                where += " AND created_at <= ?"
+                p.append(ts)
+            elif kind > last_kind:
+                where += " AND created_at < ?"
+                p.append(ts)
+            else:
+                where += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+                p += [ts, ts, last_id]
+        parts.append(
+            f"SELECT * FROM (SELECT {kind} AS kind, id, chat_id, reason, created_at FROM {{s}}.{t} "
+            f"WHERE {where} ORDER BY created_at DESC, id DESC LIMIT {{limit}})"
+        )
+        params += p
+    sql = " UNION ALL ".join(parts) + " ORDER BY created_at DESC, kind DESC, id DESC LIMIT {limit}"
+    return history_query(sql, tuple(params), limit)
 
 
 def add_ban(chat_id: int, user_id: int, banned_by: int, reason: Optional[str], source: str):
@@ -296,6 +925,7 @@ def add_ban(chat_id: int, user_id: int, banned_by: int, reason: Optional[str], s
         INSERT INTO bans(chat_id, user_id, banned_by, reason, created_at, source)
         VALUES (?, ?, ?, ?, ?, ?)
     """, (chat_id, user_id, banned_by, reason, datetime.now(timezone.utc).isoformat(), source))
+    stats_bump(cur, chat_id, "ban", source)
     conn.commit()
     conn.close()
 
@@ -307,6 +937,7 @@ def add_unban(chat_id: int, user_id: int, unbanned_by: int, reason: Optional[str
         INSERT INTO unbans(chat_id, user_id, unbanned_by, reason, created_at)
         VALUES (?, ?, ?, ?, ?)
     """, (chat_id, user_id, unbanned_by, reason, datetime.now(timezone.utc).isoformat()))
+    stats_bump(cur, chat_id, "unban")
     conn.commit()
     conn.close()
 
@@ -327,6 +958,7 @@ def bw_add(chat_id: int, word: str, created_by: int) -> bool:
     """, (chat_id, w, created_by, datetime.now(timezone.utc).isoformat()))
     conn.commit()
     conn.close()
+    invalidate_chat_cache(chat_id)
     return True
 
 
@@ -340,6 +972,7 @@ def bw_remove(chat_id: int, word: str) -> bool:
     changed = cur.rowcount > 0
     conn.commit()
     conn.close()
+    invalidate_chat_cache(chat_id)
     return changed
 
 
@@ -352,64 +985,439 @@ def bw_list(chat_id: int) -> list[str]:
     return words
 
 
-# -------------------- HELPERS --------------------
-def is_group(update: Update) -> bool:
-    return bool(update.effective_chat and update.effective_chat.type in (ChatType.GROUP, ChatType.SUPERGROUP))
-
+def add_sanction(chat_id: int, user_id: int, kind: str, created_by: int, reason: Optional[str], expires_at: float,
+                 bot_id: Optional[int] = None) -> int:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO sanctions(chat_id, user_id, kind, created_by, reason, created_at, expires_at, bot_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (chat_id, user_id, kind, created_by, reason, datetime.now(timezone.utc).isoformat(), expires_at, bot_id))
+    sid = int(cur.lastrowid)
+    conn.commit()
+    conn.close()
+    return sid
 
-async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: Optional[int] = None) -> bool:
-    chat = update.effective_chat
-    if not chat:
-        return False
-    uid = user_id if user_id is not None else (update.effective_user.id if update.effective_user else None)
-    if uid is None:
-        return False
-    member = await context.bot.get_chat_member(chat.id, uid)
-    return member.status in ("administrator", "creator")
 
+def get_sanction(sanction_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM sanctions WHERE id = ?", (sanction_id,))
+    row = cur.fetchone()
+    conn.close()
+    return row
 
-def target_user_id_from_reply(update: Update) -> Optional[int]:
-    msg = update.effective_message
-    if msg and msg.reply_to_message and msg.reply_to_message.from_user:
-        return msg.reply_to_message.from_user.id
-    return None
 
+def end_sanction(sanction_id: int):
+    conn = db()
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE sanctions SET active = 0, ended_at = ? WHERE id = ?",
+        (datetime.now(timezone.utc).isoformat(), sanction_id),
+    )
+    conn.commit()
+    conn.close()
 
-def clamp(n: int, lo: int, hi: int) -> int:
-    return max(lo, min(hi, n))
 
+def revoke_sanctions(chat_id: int, user_id: int, kind: str) -> list[int]:
+    """Cierra antes de tiempo las sanciones activas de ese tipo. Devuelve sus ids."""
+    conn = db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id FROM sanctions WHERE chat_id = ? AND active = 1 AND user_id = ? AND kind = ?",
+        (chat_id, user_id, kind),
+    )
+    ids = [int(r["id"]) for r in cur.fetchall()]
+    cur.executemany(
+        "UPDATE sanctions SET active = 0, ended_at = ? WHERE id = ?",
+        [(datetime.now(timezone.utc).isoformat(), sid) for sid in ids],
+    )
+    conn.commit()
+    conn.close()
+    return ids
 
-def normalize_word(word: str) -> str:
-    w = (word or "").strip().lower()
-    # simple: no espacios
-    w = w.replace("\n", " ").strip()
-    if not w:
-        return ""
-    # si te mandan "palabra,": recorta signos comunes
-    w = w.strip(" \t.,;:!?\"'()[]{}<>")
-    return w
 
+def list_active_sanctions(chat_id: int, limit: int = SANCTIONS_LIST_LIMIT) -> list[sqlite3.Row]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, user_id, kind, reason, expires_at
+        FROM sanctions
+        WHERE chat_id = ? AND active = 1
+        ORDER BY expires_at ASC
+        LIMIT ?
+    """, (chat_id, limit))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
 
-async def send_modlog(context: ContextTypes.DEFAULT_TYPE, group_chat_id: int, text: str):
-    log_chat_id = get_log_chat_id(group_chat_id)
-    if not log_chat_id:
-        return
-    try:
-        await context.bot.send_message(chat_id=log_chat_id, text=text)
-    except Exception:
-        return
 
+def load_pending_sanctions(bot_id: int) -> list[tuple[int, float]]:
+    """Sanciones activas de este bot. Las viejas sin bot_id las adopta el primer bot que arranca."""
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE sanctions SET bot_id = ? WHERE bot_id IS NULL AND active = 1", (bot_id,))
+    conn.commit()
+    cur.execute("SELECT id, expires_at FROM sanctions WHERE active = 1 AND bot_id = ?", (bot_id,))
+    rows = [(int(r["id"]), float(r["expires_at"])) for r in cur.fetchall()]
+    conn.close()
+    return rows
 
-async def maybe_autoban_after_warn(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, target_id: int, actor_id: int, source: str):
-    total = count_warns(chat_id, target_id)
-    limit = get_warn_limit(chat_id)
-    if total < limit:
-        return
 
-    try:
-        await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
-        add_ban(chat_id, target_id, actor_id, f"Auto-ban por {limit} warns", source=source)
-        await update.effective_message.reply_text(f"⛔ Usuario {target_id} baneado por alcanzar {limit} warns.")
+def media_block_add(chat_id: int, file_unique_id: str, kind: str, phash: Optional[int], created_by: int) -> bool:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT OR IGNORE INTO media_blocklist(chat_id, file_unique_id, kind, phash, created_by, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (chat_id, file_unique_id, kind, to_signed64(phash) if phash is not None else None, created_by,
+          datetime.now(timezone.utc).isoformat()))
+    added = cur.rowcount > 0
+    conn.commit()
+    conn.close()
+    MEDIA_BLOCKLISTS.pop(chat_id, None)
+    return added
+
+
+def media_block_remove(chat_id: int, file_unique_id: str) -> bool:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM media_blocklist WHERE chat_id = ? AND file_unique_id = ?", (chat_id, file_unique_id))
+    changed = cur.rowcount > 0
+    conn.commit()
+    conn.close()
+    MEDIA_BLOCKLISTS.pop(chat_id, None)
+    return changed
+
+
+def media_block_rows(chat_id: int) -> list[sqlite3.Row]:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT file_unique_id, phash FROM media_blocklist WHERE chat_id = ?", (chat_id,))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def bw_matcher(chat_id: int) -> Optional[re.Pattern]:
+    """Regex compilada con todas las banned words del chat (más largas primero). None si no hay."""
+    if chat_id not in BW_MATCHERS:
+        words = sorted((w for w in bw_list(chat_id) if w), key=len, reverse=True)
+        BW_MATCHERS[chat_id] = re.compile("|".join(map(re.escape, words))) if words else None
+    return BW_MATCHERS[chat_id]
+
+
+def get_stats(chat_id: int, hours: int) -> dict[str, dict[str, int]]:
+    """Suma los rollups de las últimas `hours` horas: {metric: {key: total}}. No toca las tablas crudas."""
+    since = (datetime.now(timezone.utc) - timedelta(hours=hours)).strftime(STATS_HOUR_FMT)
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT metric, key, SUM(value) AS v
+        FROM stats_hourly
+        WHERE chat_id = ? AND hour > ?
+        GROUP BY metric, key
+    """, (chat_id, since))
+    out: dict[str, dict[str, int]] = {}
+    for r in cur.fetchall():
+        out.setdefault(r["metric"], {})[r["key"]] = int(r["v"])
+    conn.close()
+    return out
+
+
+def prune_stats(older_than_days: int = STATS_RETENTION_DAYS) -> int:
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).strftime(STATS_HOUR_FMT)
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM stats_hourly WHERE hour < ?", (cutoff,))
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+# -------------------- ARCHIVE (RETENCIÓN) --------------------
+# Las filas de auditoría más viejas que ARCHIVE_AFTER_DAYS se mueven a un SQLite por mes
+# (archive/bot-YYYY-MM.db). Los warns archivados ya no cuentan para el auto-ban.
+ARCHIVED_TABLES = ("warns", "bans", "unbans")
+AUDIT_INDEXES = (
+    [("idx_warns_chat_user", "warns", "chat_id, user_id, id")]
+    + [(f"idx_{t}_created", t, "created_at") for t in ARCHIVED_TABLES]
+    + [(f"idx_{t}_user", t, "user_id, created_at, chat_id") for t in ARCHIVED_TABLES]
+)
+
+
+def archive_path(month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"bot-{month}.db")
+
+
+def archive_files() -> list[str]:
+    """Archivos mensuales, del más reciente al más antiguo."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    names = [n for n in os.listdir(ARCHIVE_DIR) if n.startswith("bot-") and n.endswith(".db")]
+    return [os.path.join(ARCHIVE_DIR, n) for n in sorted(names, reverse=True)]
+
+
+def next_month(month: str) -> str:
+    year, mon = int(month[:4]), int(month[5:7])
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{year:04d}-{mon:02d}"
+
+
+def ensure_archive_tables(conn: sqlite3.Connection):
+    """Crea en `arc` las tablas de auditoría copiando el esquema de la DB caliente."""
+    cur = conn.cursor()
+    for t in ARCHIVED_TABLES:
+        cur.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (t,))
+        ddl = cur.fetchone()[0]
+        cur.execute(ddl.replace(f"CREATE TABLE {t}", f"CREATE TABLE IF NOT EXISTS arc.{t}", 1))
+    for name, t, cols in AUDIT_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS arc.{name} ON {t}({cols})")
+
+
+def archive_old_rows(older_than_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """Mueve filas antiguas a los archivos mensuales y hace incremental vacuum. Devuelve filas movidas."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).isoformat()
+    conn = db()
+    cur = conn.cursor()
+
+    months = set()
+    for t in ARCHIVED_TABLES:
+        cur.execute(f"SELECT DISTINCT substr(created_at, 1, 7) AS m FROM {t} WHERE created_at < ?", (cutoff,))
+        months.update(r["m"] for r in cur.fetchall())
+    if not months:
+        conn.close()
+        return 0
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    moved = 0
+    for month in sorted(months):
+        lo, hi = f"{month}-01", f"{next_month(month)}-01"
+        cur.execute("ATTACH DATABASE ? AS arc", (archive_path(month),))
+        try:
+            ensure_archive_tables(conn)
+            for t in ARCHIVED_TABLES:
+                cols = ", ".join(sorted(get_columns(conn, t) & {r[1] for r in cur.execute(f"PRAGMA arc.table_info({t})")}))
+                where = "created_at >= ? AND created_at < ? AND created_at < ?"
+                cur.execute(f"INSERT OR IGNORE INTO arc.{t}({cols}) SELECT {cols} FROM main.{t} WHERE {where}", (lo, hi, cutoff))
+                cur.execute(f"DELETE FROM main.{t} WHERE {where}", (lo, hi, cutoff))
+                moved += cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("DETACH DATABASE arc")
+
+    cur.execute("PRAGMA incremental_vacuum")
+    cur.fetchall()
+    conn.close()
+    return moved
+
+
+def history_db() -> sqlite3.Connection:
+    """Conexión a la DB caliente que permite ATTACH de archivos en solo-lectura (URI)."""
+    if CURRENT_PROFILE.get() is not None:
+        return profiled_connect(f"file:{DB_PATH}", sys._getframe(1).f_code.co_name, uri=True)
+    conn = sqlite3.connect(f"file:{DB_PATH}", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def history_query(sql: str, params: tuple, limit: int) -> list[sqlite3.Row]:
+    """
+    Ejecuta `sql` (con `{s}` como esquema y `{limit}` como límite) en la DB caliente y luego en
+    los archivos (más reciente primero) hasta juntar `limit` filas. Como el archivo parte por
+    tiempo, el resultado queda en orden descendente sin mezclar.
+    """
+    conn = history_db()
+    cur = conn.cursor()
+    cur.execute(sql.format(s="main", limit=int(limit)), params)
+    rows = cur.fetchall()
+    for path in archive_files():
+        if len(rows) >= limit:
+            break
+        cur.execute("ATTACH DATABASE ? AS arc", (f"file:{path}?mode=ro",))
+        try:
+            cur.execute(sql.format(s="arc", limit=int(limit - len(rows))), params)
+            rows.extend(cur.fetchall())
+        finally:
+            cur.execute("DETACH DATABASE arc")
+    conn.close()
+    return rows
+
+
+async def archive_loop():
+    while True:
+        try:
+            moved = await asyncio.to_thread(archive_old_rows)
+            if moved:
+                print(f"🗄️ Archivadas {moved} filas de auditoría")
+            await asyncio.to_thread(prune_stats)
+        except Exception as e:
+            print(f"⚠️ Error archivando: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+# -------------------- HELPERS --------------------
+def is_group(update: Update) -> bool:
+    return bool(update.effective_chat and update.effective_chat.type in (ChatType.GROUP, ChatType.SUPERGROUP))
+
+
+ADMIN_CACHE: dict[tuple[int, int], tuple[bool, float]] = {}
+
+
+async def is_chat_admin(bot, chat_id: int, user_id: int) -> bool:
+    # cache corto: evita un get_chat_member por cada mensaje / botón
+    now = time.monotonic()
+    hit = ADMIN_CACHE.get((chat_id, user_id))
+    if hit and hit[1] > now:
+        return hit[0]
+    member = await bot.get_chat_member(chat_id, user_id)
+    result = member.status in ("administrator", "creator")
+    if len(ADMIN_CACHE) >= ADMIN_CACHE_MAX:
+        ADMIN_CACHE.clear()
+    ADMIN_CACHE[(chat_id, user_id)] = (result, now + ADMIN_CACHE_TTL)
+    return result
+
+
+async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: Optional[int] = None) -> bool:
+    chat = update.effective_chat
+    if not chat:
+        return False
+    uid = user_id if user_id is not None else (update.effective_user.id if update.effective_user else None)
+    if uid is None:
+        return False
+    return await is_chat_admin(context.bot, chat.id, uid)
+
+
+HISTORY_SCOPES: "OrderedDict[tuple[int, int], tuple[list[int], float]]" = OrderedDict()
+
+
+HISTORY_LAST_SCAN: dict[int, float] = {}  # admin_id -> último escaneo sin cache
+
+
+async def history_scope(context: ContextTypes.DEFAULT_TYPE, admin_id: int, target_id: int,
+                        throttle: bool = False) -> Optional[list[int]]:
+    """
+    Chats de `target_id` visibles para `admin_id`. Se calcula una vez (archivos + get_chat_member)
+    y las páginas siguientes lo reutilizan durante HISTORY_SCOPE_TTL. Con `throttle`, un escaneo
+    nuevo antes de HISTORY_SCAN_COOLDOWN devuelve None.
+    """
+    key = (admin_id, target_id)
+    now = time.monotonic()
+    hit = HISTORY_SCOPES.get(key)
+    if hit and hit[1] > now:
+        HISTORY_SCOPES.move_to_end(key)
+        return hit[0]
+    if throttle:
+        if now - HISTORY_LAST_SCAN.get(admin_id, -HISTORY_SCAN_COOLDOWN) < HISTORY_SCAN_COOLDOWN:
+            return None
+        if len(HISTORY_LAST_SCAN) >= HISTORY_SCOPE_MAX:
+            HISTORY_LAST_SCAN.clear()
+        HISTORY_LAST_SCAN[admin_id] = now
+    chat_ids = await admin_chats_of(context, admin_id, history_user_chats(target_id))
+    HISTORY_SCOPES[key] = (chat_ids, now + HISTORY_SCOPE_TTL)
+    HISTORY_SCOPES.move_to_end(key)
+    while len(HISTORY_SCOPES) > HISTORY_SCOPE_MAX:
+        HISTORY_SCOPES.popitem(last=False)
+    return chat_ids
+
+
+async def history_chats(context: ContextTypes.DEFAULT_TYPE, chat, user_id: int, target_id: int,
+                        throttle: bool = False) -> Optional[list[int]]:
+    """En un grupo: solo ese grupo (y solo para admins). En privado: todos los grupos donde es admin."""
+    if chat and chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+        return [chat.id] if await is_chat_admin(context.bot, chat.id, user_id) else []
+    return await history_scope(context, user_id, target_id, throttle)
+
+
+async def admin_chats_of(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_ids) -> list[int]:
+    """Filtra `chat_ids` a los chats donde `user_id` es admin (si el bot ya no está, se ignora)."""
+    out = []
+    for cid in sorted(chat_ids):
+        try:
+            if await is_chat_admin(context.bot, cid, user_id):
+                out.append(cid)
+        except Exception:
+            continue
+    return out
+
+
+def target_user_id_from_reply(update: Update) -> Optional[int]:
+    msg = update.effective_message
+    if msg and msg.reply_to_message and msg.reply_to_message.from_user:
+        return msg.reply_to_message.from_user.id
+    return None
+
+
+async def delete_messages_batched(bot, chat_id: int, message_ids) -> int:
+    """Borra en lotes de DELETE_BATCH_SIZE (una llamada por lote). Devuelve los lotes que fallaron."""
+    ids = list(message_ids)
+    failed = 0
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=ids[i:i + DELETE_BATCH_SIZE])
+        except Exception:
+            failed += 1
+    return failed
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def iso_to_us(iso: str) -> int:
+    return (datetime.fromisoformat(iso) - EPOCH) // timedelta(microseconds=1)
+
+
+def us_to_iso(us: int) -> str:
+    # mismo formato que created_at (isoformat() sin timespec): si no, el cursor no compara igual
+    return (EPOCH + timedelta(microseconds=us)).isoformat()
+
+
+def clamp(n: int, lo: int, hi: int) -> int:
+    return max(lo, min(hi, n))
+
+
+def normalize_word(word: str) -> str:
+    w = (word or "").strip().lower()
+    # simple: no espacios
+    w = w.replace("\n", " ").strip()
+    if not w:
+        return ""
+    # si te mandan "palabra,": recorta signos comunes
+    w = w.strip(" \t.,;:!?\"'()[]{}<>")
+    return w
+
+
+async def send_modlog(context: ContextTypes.DEFAULT_TYPE, group_chat_id: int, text: str):
+    if LOAD.degraded:
+        return LOAD.suppress(group_chat_id)
+    await send_modlog_bot(context.bot, group_chat_id, text)
+
+
+async def send_modlog_bot(bot, group_chat_id: int, text: str):
+    log_chat_id = get_log_chat_id(group_chat_id)
+    if not log_chat_id:
+        return
+    try:
+        await bot.send_message(chat_id=log_chat_id, text=text)
+    except Exception:
+        return
+
+
+async def maybe_autoban_after_warn(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, target_id: int, actor_id: int, source: str):
+    total = count_warns(chat_id, target_id)
+    limit = get_warn_limit(chat_id)
+    if total < limit:
+        return
+
+    try:
+        await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
+        add_ban(chat_id, target_id, actor_id, f"Auto-ban por {limit} warns", source=source)
+        revoke_and_cancel(context, chat_id, target_id, "ban")  # un tempban previo no debe levantarlo
+        await send_notice(context, chat_id, banned=target_id, text=f"⛔ Usuario {target_id} baneado por alcanzar {limit} warns.")
         await send_modlog(
             context,
             chat_id,
@@ -420,6 +1428,711 @@ async def maybe_autoban_after_warn(update: Update, context: ContextTypes.DEFAULT
         await send_modlog(context, chat_id, f"⚠️ ERROR AUTO-BAN\nGrupo: {chat_id}\nUsuario: {target_id}\nError: {e}")
 
 
+# -------------------- ÍNDICE DE USUARIOS (@USERNAME → USER_ID) --------------------
+class UserIndex:
+    """
+    @username -> user_id y (chat, user) -> última vez visto, en LRUs acotados. Se alimenta de
+    cada update (sin llamadas a la API) y los cambios se guardan por lotes; lo que sale del LRU
+    se vuelve a leer de SQLite si hace falta. `ids` (user_id -> @ actual) permite olvidar el @
+    viejo cuando un usuario se lo cambia o se lo quita.
+    """
+
+    def __init__(self, max_names: int = USER_NAMES_MAX, max_seen: int = USER_SEEN_MAX):
+        self.max_names = max_names
+        self.max_seen = max_seen
+        self.names: "OrderedDict[str, tuple[int, float]]" = OrderedDict()  # @ -> (user_id, visto)
+        self.ids: dict[int, str] = {}
+        self.seen: "OrderedDict[tuple[int, int], float]" = OrderedDict()
+        self._dirty_names: dict[str, tuple[int, float]] = {}
+        self._dirty_seen: dict[tuple[int, int], float] = {}
+        self._dropped: set[int] = set()
+
+    def observe(self, user, chat_id: Optional[int] = None):
+        if not user or user.is_bot:
+            return
+        now = time.time()
+        if user.username:
+            key = user.username.lower()
+            hit = self.names.get(key)
+            if hit is None or hit[0] != user.id or now - hit[1] >= USER_SEEN_RESOLUTION:
+                self._dirty_names[key] = (user.id, now)
+                self._dropped.discard(user.id)
+            self._remember(key, user.id, now)
+        elif user.id in self.ids:
+            self._forget(self.ids.pop(user.id), user.id)
+            self._dropped.add(user.id)
+        if chat_id is not None:
+            key = (chat_id, user.id)
+            last = self.seen.get(key)
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            if last is None or now - last >= USER_SEEN_RESOLUTION:
+                self._dirty_seen[key] = now
+            while len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+
+    def _remember(self, key: str, user_id: int, ts: float):
+        old = self.ids.get(user_id)
+        if old is not None and old != key:
+            self._forget(old, user_id)
+        prev = self.names.get(key)
+        if prev and prev[0] != user_id and self.ids.get(prev[0]) == key:
+            del self.ids[prev[0]]  # otro usuario tenía este @ antes
+        self.names[key] = (user_id, ts)
+        self.names.move_to_end(key)
+        self.ids[user_id] = key
+        while len(self.names) > self.max_names:
+            k, (uid, _) = self.names.popitem(last=False)
+            if self.ids.get(uid) == k:
+                del self.ids[uid]
+
+    def _forget(self, key: str, user_id: int):
+        if self.names.get(key, (None,))[0] == user_id:
+            del self.names[key]
+        if self._dirty_names.get(key, (None,))[0] == user_id:
+            del self._dirty_names[key]
+
+    def lookup(self, username: str) -> Optional[tuple[int, float]]:
+        """(user_id, última vez visto con ese @) o None."""
+        key = username.lstrip("@").lower()
+        hit = self.names.get(key)
+        if hit is not None:
+            self.names.move_to_end(key)
+            return hit
+        hit = load_username(key)
+        if hit is None:
+            return None
+        user_id, ts = hit
+        if user_id in self._dropped or self.ids.get(user_id, key) != key:
+            return None  # en SQLite todavía está el @ viejo (se borra en el próximo flush)
+        self._remember(key, user_id, ts)
+        return hit
+
+    def resolve(self, username: str) -> Optional[int]:
+        hit = self.lookup(username)
+        return hit[0] if hit else None
+
+    def username_of(self, user_id: int) -> Optional[tuple[str, float]]:
+        key = self.ids.get(user_id)
+        if key is not None:
+            return key, self.names[key][1]
+        if user_id in self._dropped:
+            return None
+        return load_username_of(user_id)
+
+    def last_seen(self, chat_id: int, user_id: int) -> Optional[float]:
+        ts = self.seen.get((chat_id, user_id))
+        return ts if ts is not None else load_last_seen(chat_id, user_id)
+
+    def pending(self) -> tuple[list[tuple], list[tuple], list[int]]:
+        names = [(k, uid, ts) for k, (uid, ts) in self._dirty_names.items()]
+        seen = [(c, u, ts) for (c, u), ts in self._dirty_seen.items()]
+        dropped = list(self._dropped)
+        self._dirty_names, self._dirty_seen, self._dropped = {}, {}, set()
+        return names, seen, dropped
+
+    def flush(self):
+        names, seen, dropped = self.pending()
+        if names or seen or dropped:
+            save_user_index(names, seen, dropped)
+
+
+USERS = UserIndex()
+
+
+async def track_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Grupo -1: alimenta el índice con cada update (autor, respondido, nuevos miembros) y anota
+    cada mensaje del grupo en RECENT (comandos, stickers, servicio...) para que /purge lo vea;
+    el texto lo completa después handle_group_message si el mensaje pasa por los filtros.
+    """
+    chat = update.effective_chat
+    chat_id = chat.id if chat and chat.type in (ChatType.GROUP, ChatType.SUPERGROUP) else None
+    USERS.observe(update.effective_user, chat_id)
+    posted = update.message or update.edited_message  # no el menú de un callback
+    if chat_id is not None and posted and update.effective_user:
+        RECENT.add(chat_id, posted.message_id, update.effective_user.id)
+    msg = update.effective_message
+    if msg:
+        if msg.reply_to_message:
+            USERS.observe(msg.reply_to_message.from_user)
+        for member in msg.new_chat_members or ():
+            USERS.observe(member, chat_id)
+
+
+def resolve_target(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                   args: Optional[list[str]] = None) -> tuple[Optional[int], list[str]]:
+    """
+    Usuario objetivo de un comando: reply, mención sin username (text_mention), @username o
+    user_id como primer argumento. Devuelve (user_id o None, argumentos restantes).
+    Solo cuenta una text_mention que empieza justo en el primer argumento, y un número solo es
+    user_id desde MIN_USER_ID (así "/mute 30" sin reply no apunta al usuario 30).
+    """
+    args = list(context.args or []) if args is None else list(args)
+    target_id = target_user_id_from_reply(update)
+    if target_id:
+        return target_id, args
+    if not args:
+        return None, args
+    first = args[0]
+    msg = update.effective_message
+    offset = first_arg_offset(msg.text or "", len(args)) if msg else None
+    for ent, text in (msg.parse_entities(["text_mention"]).items() if msg else ()):
+        if ent.user and ent.offset == offset:
+            return ent.user.id, args[len(text.split()):]
+    if first.startswith("@") and len(first) > 1:
+        return USERS.resolve(first), args[1:]
+    if first.isdigit() and int(first) >= MIN_USER_ID:
+        return int(first), args[1:]
+    return None, args
+
+
+def first_arg_offset(text: str, n_args: int) -> Optional[int]:
+    """Offset (en unidades UTF-16, como las entidades de Telegram) del primero de los últimos `n_args` tokens."""
+    starts = [m.start() for m in re.finditer(r"\S+", text)]
+    if n_args < 1 or n_args > len(starts):
+        return None
+    return len(text[:starts[-n_args]].encode("utf-16-le")) // 2
+
+
+async def user_index_flush_loop():
+    while True:
+        await asyncio.sleep(USER_INDEX_FLUSH_SECONDS)
+        try:
+            names, seen, dropped = USERS.pending()
+            if names or seen or dropped:
+                await asyncio.to_thread(save_user_index, names, seen, dropped)
+        except Exception as e:
+            print(f"⚠️ Error guardando índice de usuarios: {e}")
+
+
+# -------------------- SANCIONES TEMPORALES (SCHEDULER) --------------------
+class SanctionScheduler:
+    """
+    Un solo timer para todas las expiraciones: heap de (expires_at, sanction_id) y una tarea
+    que duerme hasta la más próxima. Cancelar es O(1) (se descarta al salir del heap).
+    """
+
+    def __init__(self, on_expire):
+        self._heap: list[tuple[float, int]] = []
+        self._pending: dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self._on_expire = on_expire
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def load(self, entries):
+        """Carga masiva (arranque): heapify en O(n)."""
+        for sid, expires_at in entries:
+            self._pending[sid] = expires_at
+        self._heap = [(exp, sid) for sid, exp in self._pending.items()]
+        heapq.heapify(self._heap)
+        self._wake.set()
+
+    def add(self, sanction_id: int, expires_at: float):
+        self._pending[sanction_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, sanction_id))
+        if self._heap[0] == (expires_at, sanction_id):
+            self._wake.set()
+
+    def cancel(self, sanction_id: int):
+        self._pending.pop(sanction_id, None)
+
+    def _drop_stale(self):
+        while self._heap and self._pending.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    async def run(self):
+        while True:
+            self._drop_stale()
+            timeout = self._heap[0][0] - time.time() if self._heap else SCHEDULER_MAX_SLEEP
+            if timeout > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min(timeout, SCHEDULER_MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, sid = heapq.heappop(self._heap)
+            self._pending.pop(sid, None)
+            try:
+                await self._on_expire(sid)
+            except Exception as e:
+                print(f"⚠️ Error expirando sanción {sid}: {e}")
+
+
+def parse_duration(raw: str) -> Optional[int]:
+    """'30m', '2h', '7d', '1w' (o solo número = minutos) → segundos."""
+    raw = (raw or "").strip().lower()
+    if raw.isdigit():
+        return int(raw) * 60
+    if len(raw) < 2 or not raw[:-1].isdigit() or raw[-1] not in DURATION_UNITS:
+        return None
+    return int(raw[:-1]) * DURATION_UNITS[raw[-1]]
+
+
+def format_remaining(seconds: float) -> str:
+    seconds = max(0, int(seconds))
+    days, rem = divmod(seconds, 86400)
+    hours, rem = divmod(rem, 3600)
+    minutes = rem // 60
+    parts = [f"{days}d" if days else "", f"{hours}h" if hours else "", f"{minutes}m" if minutes or not (days or hours) else ""]
+    return " ".join(p for p in parts if p)
+
+
+SCHEDULERS: dict[int, SanctionScheduler] = {}  # bot.id -> scheduler (para reintentos)
+
+
+def get_scheduler(context: ContextTypes.DEFAULT_TYPE) -> Optional[SanctionScheduler]:
+    return context.bot_data.get(SCHEDULER_KEY)
+
+
+SANCTION_FAILURES: dict[int, int] = {}  # sanction_id -> unbans fallidos seguidos
+
+
+async def expire_sanction(bot, sanction_id: int):
+    row = get_sanction(sanction_id)
+    if not row or not row["active"]:
+        return
+    chat_id, user_id = int(row["chat_id"]), int(row["user_id"])
+
+    if row["kind"] == "ban":
+        try:
+            await bot.unban_chat_member(chat_id=chat_id, user_id=user_id, only_if_banned=True)
+        except Exception as e:
+            # Forbidden/BadRequest (bot expulsado, chat borrado...) no se arreglan reintentando
+            attempt = SANCTION_FAILURES.get(sanction_id, 0) + 1
+            scheduler = SCHEDULERS.get(bot.id)
+            if isinstance(e, (Forbidden, BadRequest)) or attempt >= SANCTION_RETRY_MAX or not scheduler:
+                SANCTION_FAILURES.pop(sanction_id, None)
+                end_sanction(sanction_id)
+                await send_modlog_bot(
+                    bot, chat_id,
+                    f"⚠️ TEMPBAN EXPIRADO SIN LEVANTAR (sanción #{sanction_id}, {attempt} intentos)\n"
+                    f"Grupo: {chat_id}\nUsuario: {user_id}\nError: {e}\nUsa /unban a mano si hace falta.",
+                )
+                return
+            SANCTION_FAILURES[sanction_id] = attempt
+            scheduler.add(sanction_id, time.time() + SANCTION_RETRY_SECONDS * 2 ** (attempt - 1))
+            if attempt == 1:  # un solo aviso mientras se reintenta
+                await send_modlog_bot(bot, chat_id, f"⚠️ ERROR TEMPBAN EXPIRADO (se reintenta)\nGrupo: {chat_id}\nUsuario: {user_id}\nError: {e}")
+            return
+        SANCTION_FAILURES.pop(sanction_id, None)
+        end_sanction(sanction_id)
+        add_unban(chat_id, user_id, 0, "tempban expirado")
+        await send_modlog_bot(bot, chat_id, f"⏱️ TEMPBAN EXPIRADO | user {user_id} | sanción #{sanction_id}")
+        return
+
+    # mute: Telegram lo levanta solo (until_date); aquí solo cerramos y avisamos
+    end_sanction(sanction_id)
+    await send_modlog_bot(bot, chat_id, f"🔊 UNMUTE (expiró) | user {user_id} | sanción #{sanction_id}")
+
+
+def revoke_and_cancel(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, kind: str) -> int:
+    ids = revoke_sanctions(chat_id, user_id, kind)
+    scheduler = get_scheduler(context)
+    if scheduler:
+        for sid in ids:
+            scheduler.cancel(sid)
+    return len(ids)
+
+
+async def start_scheduler(app: Application):
+    bot = app.bot
+
+    async def on_expire(sid: int):
+        await expire_sanction(bot, sid)
+
+    scheduler = SanctionScheduler(on_expire)
+    scheduler.load(load_pending_sanctions(bot.id))
+    app.bot_data[SCHEDULER_KEY] = scheduler
+    SCHEDULERS[bot.id] = scheduler
+    spawn(app, scheduler.run())
+    if len(scheduler):
+        print(f"⏱️ {len(scheduler)} sanciones temporales pendientes")
+
+
+# -------------------- MEDIA BLOCKLIST --------------------
+# Camino rápido: set de file_unique_id (sin descargar nada).
+# Camino lento (opcional, requiere Pillow): dHash de 64 bits de la miniatura + BK-tree por chat.
+class BKTree:
+    """BK-tree sobre distancia de Hamming para buscar hashes cercanos."""
+
+    def __init__(self):
+        self.root: Optional[list] = None  # [hash, {distancia: nodo}]
+        self.size = 0
+
+    def add(self, h: int):
+        if self.root is None:
+            self.root = [h, {}]
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            d = (node[0] ^ h).bit_count()
+            if d == 0:
+                return  # ya está: no cuenta dos veces
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [h, {}]
+                self.size += 1
+                return
+            node = child
+
+    def find(self, h: int, max_dist: int) -> Optional[int]:
+        if self.root is None:
+            return None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ h).bit_count()
+            if d <= max_dist:
+                return node[0]
+            for dist, child in node[1].items():
+                if d - max_dist <= dist <= d + max_dist:
+                    stack.append(child)
+        return None
+
+
+class MediaBlocklist:
+    __slots__ = ("ids", "hashes")
+
+    def __init__(self, rows):
+        self.ids: set[str] = set()
+        self.hashes = BKTree()
+        for r in rows:
+            self.ids.add(r["file_unique_id"])
+            if r["phash"] is not None:
+                self.hashes.add(from_signed64(r["phash"]))
+
+
+MEDIA_BLOCKLISTS: dict[int, MediaBlocklist] = {}
+PHASH_CACHE: "OrderedDict[str, Optional[int]]" = OrderedDict()  # file_unique_id -> dHash (o None)
+
+
+def to_signed64(h: int) -> int:
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def from_signed64(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+def media_blocklist(chat_id: int) -> MediaBlocklist:
+    bl = MEDIA_BLOCKLISTS.get(chat_id)
+    if bl is None:
+        bl = MEDIA_BLOCKLISTS[chat_id] = MediaBlocklist(media_block_rows(chat_id))
+    return bl
+
+
+def media_of(msg) -> Optional[tuple[str, str, object]]:
+    """(kind, file_unique_id, miniatura o None) del media del mensaje."""
+    if msg.sticker:
+        return "sticker", msg.sticker.file_unique_id, msg.sticker.thumbnail
+    if msg.animation:
+        return "animation", msg.animation.file_unique_id, msg.animation.thumbnail
+    if msg.photo:
+        # el id se toma del tamaño mayor; la miniatura es el menor
+        return "photo", msg.photo[-1].file_unique_id, msg.photo[0]
+    if msg.video:
+        return "video", msg.video.file_unique_id, msg.video.thumbnail
+    if msg.video_note:
+        return "video_note", msg.video_note.file_unique_id, msg.video_note.thumbnail
+    if msg.document:
+        return "document", msg.document.file_unique_id, msg.document.thumbnail
+    return None
+
+
+def dhash(data: bytes) -> int:
+    """dHash 64 bits: gris 9x8, compara píxeles vecinos."""
+    with Image.open(io.BytesIO(data)) as img:
+        px = list(img.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+
+async def media_phash(bot, unique_id: str, thumb) -> Optional[int]:
+    """Hash perceptual de la miniatura (cacheado por file_unique_id). None si no aplica."""
+    if Image is None or thumb is None:
+        return None
+    if unique_id in PHASH_CACHE:
+        PHASH_CACHE.move_to_end(unique_id)
+        return PHASH_CACHE[unique_id]
+    try:
+        f = await bot.get_file(thumb.file_id)
+        data = bytes(await f.download_as_bytearray())
+        h = await asyncio.to_thread(dhash, data)
+    except Exception:
+        h = None
+    PHASH_CACHE[unique_id] = h
+    while len(PHASH_CACHE) > PHASH_CACHE_SIZE:
+        PHASH_CACHE.popitem(last=False)
+    return h
+
+
+async def media_hit(bot, chat_id: int, media: tuple[str, str, object]) -> Optional[str]:
+    """Devuelve el motivo si el media está bloqueado en el chat."""
+    kind, unique_id, thumb = media
+    bl = media_blocklist(chat_id)
+    if unique_id in bl.ids:
+        return f"{kind} bloqueado"
+    if not bl.hashes.size:
+        return None
+    h = await media_phash(bot, unique_id, thumb)
+    if h is not None and bl.hashes.find(h, MEDIA_PHASH_MAX_DISTANCE) is not None:
+        return f"{kind} similar a uno bloqueado"
+    return None
+
+
+# -------------------- AVISOS AGRUPADOS --------------------
+class ChatNotice:
+    """Un aviso abierto en un chat: se edita en el sitio mientras dura la ventana."""
+    __slots__ = ("opened", "closes", "message_id", "removed", "warned", "banned", "first_text", "rendered", "edit_task")
+
+    def __init__(self, opened: float):
+        self.opened = opened
+        self.closes = opened + NOTICE_WINDOW_SECONDS  # se acorta si el TTL del chat es menor
+        self.message_id: Optional[int] = None
+        self.removed = 0
+        self.warned: set[int] = set()
+        self.banned: set[int] = set()
+        self.first_text: Optional[str] = None
+        self.rendered: Optional[str] = None
+        self.edit_task: Optional[asyncio.Task] = None
+
+    def render(self) -> str:
+        if self.first_text and self.removed + len(self.banned) <= 1:
+            return self.first_text
+        parts = []
+        if self.removed:
+            parts.append(f"🚫 {self.removed} mensajes eliminados")
+        if self.warned:
+            parts.append(f"⚠️ {len(self.warned)} usuarios con warn")
+        if self.banned:
+            parts.append(f"⛔ {len(self.banned)} baneados")
+        return " · ".join(parts)
+
+
+class NoticeAggregator:
+    """
+    Un aviso por chat y ventana (NOTICE_WINDOW_SECONDS): el primer evento envía el mensaje y
+    los siguientes lo editan (como mucho uno cada NOTICE_EDIT_INTERVAL). Cada aviso se borra
+    tras el TTL del chat, en lotes con delete_messages; con un TTL más corto que la ventana,
+    la ventana cierra antes para no editar un mensaje ya borrado.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.open: dict[int, ChatNotice] = {}
+        self._expiring: list[tuple[float, int, int]] = []  # heap (vence, chat_id, message_id)
+
+    async def add(self, chat_id: int, *, removed: int = 0, warned: Optional[int] = None,
+                  banned: Optional[int] = None, text: Optional[str] = None):
+        now = time.monotonic()
+        notice = self.open.get(chat_id)
+        fresh = notice is None or now >= notice.closes
+        if fresh:
+            notice = self.open[chat_id] = ChatNotice(now)
+            notice.first_text = text
+
+        notice.removed += removed
+        if warned is not None:
+            notice.warned.add(warned)
+        if banned is not None:
+            notice.banned.add(banned)
+
+        if fresh:
+            await self._send(chat_id, notice)
+        else:
+            self._schedule_edit(chat_id, notice)
+
+    async def _send(self, chat_id: int, notice: ChatNotice):
+        text = notice.render()
+        try:
+            msg = await self.bot.send_message(chat_id=chat_id, text=text)
+        except Exception:
+            self.open.pop(chat_id, None)
+            return
+        notice.message_id = msg.message_id
+        notice.rendered = text
+        ttl = get_notice_ttl(chat_id)
+        if ttl:
+            expires = time.monotonic() + ttl
+            notice.closes = min(notice.closes, expires - NOTICE_EDIT_INTERVAL)
+            heapq.heappush(self._expiring, (expires, chat_id, msg.message_id))
+        if notice.render() != text:
+            self._schedule_edit(chat_id, notice)
+
+    def _schedule_edit(self, chat_id: int, notice: ChatNotice):
+        if notice.edit_task and not notice.edit_task.done():
+            return
+
+        async def fire():
+            await asyncio.sleep(NOTICE_EDIT_INTERVAL)
+            text = notice.render()
+            if notice.message_id is None or text == notice.rendered:
+                return
+            try:
+                await self.bot.edit_message_text(chat_id=chat_id, message_id=notice.message_id, text=text)
+                notice.rendered = text
+            except Exception:
+                pass
+
+        notice.edit_task = asyncio.create_task(fire())
+
+    async def run(self):
+        """Borra los avisos vencidos (agrupados por chat) y olvida las ventanas cerradas."""
+        while True:
+            await asyncio.sleep(NOTICE_SWEEP_SECONDS)
+            now = time.monotonic()
+            due: dict[int, list[int]] = {}
+            while self._expiring and self._expiring[0][0] <= now:
+                _, chat_id, message_id = heapq.heappop(self._expiring)
+                due.setdefault(chat_id, []).append(message_id)
+            for chat_id, ids in due.items():
+                notice = self.open.get(chat_id)
+                if notice and notice.message_id in ids:
+                    del self.open[chat_id]  # su mensaje ya no existe: el próximo evento abre otro
+                await delete_messages_batched(self.bot, chat_id, ids)
+            for chat_id in [c for c, n in self.open.items() if now >= n.closes]:
+                del self.open[chat_id]
+
+
+def get_notices(context: ContextTypes.DEFAULT_TYPE) -> Optional[NoticeAggregator]:
+    return context.bot_data.get(NOTICES_KEY)
+
+
+async def send_notice(context: ContextTypes.DEFAULT_TYPE, chat_id: int, **event):
+    """Aviso de moderación en el chat: agrupado, o solo contado en modo degradado."""
+    if LOAD.degraded:
+        return LOAD.suppress(chat_id)
+    notices = get_notices(context)
+    if notices:
+        await notices.add(chat_id, **event)
+
+
+# -------------------- MENSAJES RECIENTES (PURGE / REVISIÓN RETROACTIVA) --------------------
+class ChatRecent:
+    """Anillo de los últimos mensajes de un chat: message_id -> (user_id, ts, texto normalizado)."""
+    __slots__ = ("messages", "by_user")
+
+    def __init__(self):
+        self.messages: "OrderedDict[int, tuple[int, float, str]]" = OrderedDict()
+        self.by_user: dict[int, dict[int, None]] = {}  # user_id -> message_ids (orden de llegada)
+
+    def remove(self, message_id: int):
+        entry = self.messages.pop(message_id, None)
+        if entry is None:
+            return
+        ids = self.by_user.get(entry[0])
+        if ids is not None:
+            ids.pop(message_id, None)
+            if not ids:
+                del self.by_user[entry[0]]
+
+
+class RecentMessages:
+    """
+    Últimos RECENT_PER_CHAT mensajes de cada chat (LRU de RECENT_CHATS_MAX chats), con índice
+    por usuario. Solo memoria: tras un reinicio /purge ve lo que llegó desde entonces.
+    """
+
+    def __init__(self, per_chat: int = RECENT_PER_CHAT, max_chats: int = RECENT_CHATS_MAX):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self.chats: "OrderedDict[int, ChatRecent]" = OrderedDict()
+
+    def add(self, chat_id: int, message_id: int, user_id: int, text: Optional[str] = None):
+        """text=None: solo anota el id (si ya estaba, conserva el texto)."""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatRecent()
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+
+        old = chat.messages.get(message_id)
+        if old is not None:  # edición: mismo lugar, texto nuevo
+            if text is not None:
+                chat.messages[message_id] = (old[0], old[1], text)
+            return
+        chat.messages[message_id] = (user_id, time.time(), text or "")
+        chat.by_user.setdefault(user_id, {})[message_id] = None
+        while len(chat.messages) > self.per_chat:
+            chat.remove(next(iter(chat.messages)))
+
+    def forget(self, chat_id: int, message_ids):
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            for mid in message_ids:
+                chat.remove(mid)
+
+    def _fresh(self, chat: ChatRecent, ids) -> list[int]:
+        cutoff = time.time() - RECENT_MAX_AGE
+        return [mid for mid in ids if chat.messages[mid][1] >= cutoff]
+
+    def in_range(self, chat_id: int, first_id: int, last_id: int) -> list[int]:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return []
+        return self._fresh(chat, [mid for mid in chat.messages if first_id <= mid <= last_id])
+
+    def of_user(self, chat_id: int, user_id: int) -> list[int]:
+        chat = self.chats.get(chat_id)
+        if chat is None or user_id not in chat.by_user:
+            return []
+        return self._fresh(chat, list(chat.by_user[user_id]))
+
+    def since(self, chat_id: int, seconds: float) -> list[tuple[int, int, str]]:
+        """(message_id, user_id, texto) de los últimos `seconds`, del más nuevo al más viejo."""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return []
+        cutoff = time.time() - seconds
+        out = []
+        for mid in reversed(chat.messages):
+            user_id, ts, text = chat.messages[mid]
+            if ts < cutoff:
+                break
+            out.append((mid, user_id, text))
+        return out
+
+
+RECENT = RecentMessages()
+
+
+async def purge_messages(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids: list[int]) -> int:
+    """Borra por lotes y los saca del anillo. Devuelve cuántos ids estaban en lotes que fallaron."""
+    failed = await delete_messages_batched(context.bot, chat_id, message_ids)
+    RECENT.forget(chat_id, message_ids)
+    return min(failed * DELETE_BATCH_SIZE, len(message_ids))
+
+
+async def retro_scan(context: ContextTypes.DEFAULT_TYPE, chat_id: int, minutes: int = RETRO_SCAN_MINUTES) -> tuple[int, int]:
+    """
+    Borra los mensajes recientes que ya contienen una banned word (p. ej. recién agregada).
+    Solo borra: no se dan warns por mensajes escritos antes de que existiera la regla.
+    Devuelve (borrados, usuarios).
+    """
+    matcher = bw_matcher(chat_id)
+    if not matcher:
+        return 0, 0
+    hits = [(mid, uid) for mid, uid, text in RECENT.since(chat_id, minutes * 60) if text and matcher.search(text)]
+    users = {uid for _, uid in hits}
+    admins = {uid for uid in users if await is_chat_admin(context.bot, chat_id, uid)}
+    ids = [mid for mid, uid in hits if uid not in admins]
+    if not ids:
+        return 0, 0
+    failed = await purge_messages(context, chat_id, ids)
+    return len(ids) - failed, len(users - admins)
+
+
 # -------------------- MENUS (CONFIG COMPLETO) --------------------
 def main_config_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
@@ -448,6 +2161,12 @@ def warn_menu_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
+def retro_scan_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🔎 Borrar lo de los últimos {RETRO_SCAN_MINUTES} min", callback_data="cfg:bw:retro")],
+    ])
+
+
 def bw_menu_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📄 Ver lista", callback_data="cfg:bw:view")],
@@ -466,24 +2185,25 @@ def log_menu_keyboard(is_on: bool) -> InlineKeyboardMarkup:
     ])
 
 
-def config_header_text(chat_id: int) -> str:
-    wl = get_warn_limit(chat_id)
-    log_id = get_log_chat_id(chat_id)
-    bw_count = len(bw_list(chat_id))
+# estado de render del menú: último (texto, teclado) por mensaje y edits pendientes (debounce)
+MENU_LAST_RENDER: "OrderedDict[tuple[int, int], tuple[str, Optional[InlineKeyboardMarkup]]]" = OrderedDict()
+MENU_PENDING_EDITS: dict[tuple[int, int], asyncio.Task] = {}
+
+
+def config_header_text(settings: sqlite3.Row) -> str:
     return (
         "⚙️ *Configuración del bot*\n\n"
-        f"• Warn limit: *{wl}*\n"
-        f"• Banned words: *{bw_count}*\n"
-        f"• Mod-log: *{'ON' if log_id else 'OFF'}*\n\n"
+        f"• Warn limit: *{settings['warn_limit']}*\n"
+        f"• Banned words: *{settings['bw_count']}*\n"
+        f"• Mod-log: *{'ON' if settings['log_chat_id'] else 'OFF'}*\n\n"
         "Selecciona una opción:"
     )
 
 
-def warn_menu_text(chat_id: int, temp_limit: int) -> str:
-    saved = get_warn_limit(chat_id)
+def warn_menu_text(settings: sqlite3.Row, temp_limit: int) -> str:
     return (
         "⚠️ *Warn limit*\n\n"
-        f"• Guardado: *{saved}*\n"
+        f"• Guardado: *{settings['warn_limit']}*\n"
         f"• Editando: *{temp_limit}*\n\n"
         "Cuando un usuario llega al límite → ⛔ auto-ban."
     )
@@ -500,8 +2220,7 @@ def bw_view_text(chat_id: int) -> str:
     return text
 
 
-def log_menu_text(chat_id: int) -> str:
-    log_id = get_log_chat_id(chat_id)
+def log_menu_text(log_id: Optional[int]) -> str:
     return (
         "🧾 *Mod-log*\n\n"
         f"Estado: *{'ON' if log_id else 'OFF'}*\n"
@@ -513,10 +2232,11 @@ def log_menu_text(chat_id: int) -> str:
 
 
 # -------------------- PRIVATE MENU --------------------
-def pm_keyboard() -> InlineKeyboardMarkup:
+def pm_keyboard(bot_username: Optional[str] = None) -> InlineKeyboardMarkup:
     add_group_url = None
-    if BOT_USERNAME and BOT_USERNAME != "TU_BOT_USERNAME_AQUI":
-        add_group_url = f"https://t.me/{BOT_USERNAME}?startgroup=1"
+    username = bot_username or BOT_USERNAME
+    if username and username != "TU_BOT_USERNAME_AQUI":
+        add_group_url = f"https://t.me/{username}?startgroup=1"
 
     row1 = [
         InlineKeyboardButton("📘 Comandos", callback_data="pm:help"),
@@ -547,11 +2267,19 @@ def pm_help_text() -> str:
         "• /config → menú completo con botones\n"
         "• /warn (reply) <razón>\n"
         "• /warns (reply)\n"
+        "• /history <user_id>  (en privado: todos tus grupos)\n"
         "• /unwarn (reply)\n"
         "• /clearwarns (reply)\n"
         "• /mute (reply) <minutos> <razón opcional>\n"
+        "• /unmute (reply)\n"
         "• /ban (reply) <razón>\n"
+        "• /tban (reply) <duración> <razón>  (30m, 2h, 7d)\n"
+        "• /sanctions → sanciones temporales activas\n"
+        "• /blockmedia (reply) → bloquea sticker/GIF/foto\n"
         "• /unban <user_id>  (o reply)\n"
+        "• /stats [24h|7d|30d]\n"
+        "• /noticettl <segundos|off> → auto-borrado de avisos\n"
+        "• /metrics → carga del bot (modo degradado, backlog, latencia)\n"
     )
 
 
@@ -569,11 +2297,96 @@ def pm_perms_text() -> str:
     )
 
 
+# -------------------- HISTORIAL / STATS (TEXTOS) --------------------
+def warns_page(chat_id: int, target_id: int, before_id: Optional[int] = None) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    total = count_warns(chat_id, target_id)
+    limit = get_warn_limit(chat_id)
+    rows = list_warns(chat_id, target_id, limit=WARNS_PAGE_SIZE + 1, before_id=before_id)
+    has_more = len(rows) > WARNS_PAGE_SIZE
+    rows = rows[:WARNS_PAGE_SIZE]
+    if not rows:
+        return ("✅ Este usuario no tiene warns." if before_id is None else "✅ No hay warns más antiguos."), None
+
+    lines = [f"📋 Warns de {target_id}: {total}/{limit}\n"]
+    for r in rows:
+        reason = r["reason"] if r["reason"] else "(sin razón)"
+        lines.append(f"• #{r['id']} — {reason}" + (" 🗄️" if r["src"] == "arc" else ""))
+    if any(r["src"] == "arc" for r in rows):
+        lines.append(f"\n🗄️ = archivado (más de {ARCHIVE_AFTER_DAYS} días): no cuenta para el límite; /clearwarns también los borra.")
+
+    buttons = []
+    if before_id is not None:
+        buttons.append(InlineKeyboardButton("⏮️ Recientes", callback_data=f"warns:{target_id}:0"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("⬅️ Más antiguos", callback_data=f"warns:{target_id}:{rows[-1]['id']}"))
+    return "\n".join(lines), (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+
+HISTORY_LABELS = ("⚠️ warn", "⛔ ban", "✅ unban")  # índice = kind (orden de ARCHIVED_TABLES)
+
+
+def history_page(user_id: int, chat_ids: list[int], cursor: Optional[tuple[str, int, int]] = None) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    rows = list_user_history(user_id, chat_ids, HISTORY_PAGE_SIZE + 1, cursor)
+    has_more = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+    if not rows:
+        return (f"✅ Sin registros para {user_id}." if cursor is None else "✅ No hay registros más antiguos."), None
+
+    lines = [f"🗂️ Historial de {user_id} ({len(chat_ids)} chats)\n"]
+    for r in rows:
+        reason = r["reason"] if r["reason"] else "(sin razón)"
+        lines.append(f"• {r['created_at'][:16].replace('T', ' ')} {HISTORY_LABELS[r['kind']]} | chat {r['chat_id']} — {reason}")
+
+    buttons = []
+    if cursor is not None:
+        buttons.append(InlineKeyboardButton("⏮️ Recientes", callback_data=f"hist:{user_id}:0"))
+    if has_more:
+        last = rows[-1]
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Más antiguos",
+            callback_data=f"hist:{user_id}:{iso_to_us(last['created_at'])}.{last['kind']}.{last['id']}",
+        ))
+    return "\n".join(lines), (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+
+def stats_text(stats: dict[str, dict[str, int]], window: str) -> str:
+    def total(metric: str) -> int:
+        return sum(stats.get(metric, {}).values())
+
+    def top(metric: str, n: int = 5) -> list[tuple[str, int]]:
+        return sorted(stats.get(metric, {}).items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+    bans = stats.get("ban", {})
+    lines = [
+        f"📊 Estadísticas ({window})\n",
+        f"• Warns: {total('warn')}",
+        f"• Bans: {total('ban')}" + (" (" + ", ".join(f"{k} {v}" for k, v in sorted(bans.items())) + ")" if bans else ""),
+        f"• Unbans: {total('unban')}",
+        f"• Mutes: {total('mute')}",
+        f"• Banned words: {total('bw_hit')} hits",
+        f"• Media bloqueada: {total('media_hit')} hits",
+    ]
+    for word, n in top("bw_hit"):
+        lines.append(f"   – {word}: {n}")
+    heuristics = stats.get("heuristic_hit", {})
+    if heuristics:
+        lines.append("• Heurísticas: " + ", ".join(f"{k} {v}" for k, v in sorted(heuristics.items())))
+    classifier = stats.get("clf_hit", {})
+    if classifier:
+        lines.append("• Clasificador: " + ", ".join(f"{k} {v}" for k, v in sorted(classifier.items())))
+    offenders = top("offender")
+    if offenders:
+        lines.append("• Top infractores (warns):")
+        for uid, n in offenders:
+            lines.append(f"   – {uid}: {n}")
+    return "\n".join(lines)
+
+
 # -------------------- COMMANDS --------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     if chat and chat.type == ChatType.PRIVATE:
-        return await update.effective_message.reply_text(pm_intro_text(), reply_markup=pm_keyboard())
+        return await update.effective_message.reply_text(pm_intro_text(), reply_markup=pm_keyboard(context.bot.username))
     await update.effective_message.reply_text("🤖 Bot activo. Admins: /config")
 
 
@@ -584,14 +2397,13 @@ async def config_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.effective_message.reply_text("❌ Solo administradores pueden configurar.")
 
     chat_id = update.effective_chat.id
-    context.chat_data[TEMP_LIMIT_KEY] = get_warn_limit(chat_id)
+    settings = get_chat_settings(chat_id)
+    context.chat_data[TEMP_LIMIT_KEY] = settings["warn_limit"]
     context.chat_data[STATE_KEY] = STATE_NONE
 
-    await update.effective_message.reply_text(
-        config_header_text(chat_id),
-        reply_markup=main_config_keyboard(),
-        parse_mode="Markdown",
-    )
+    text, markup = config_header_text(settings), main_config_keyboard()
+    msg = await update.effective_message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
+    remember_render((chat_id, msg.message_id), text, markup)
 
 
 async def warn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -602,12 +2414,13 @@ async def warn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     admin_id = update.effective_user.id
-    target_id = target_user_id_from_reply(update)
+    target_id, args = resolve_target(update, context)
     if not target_id:
-        return await update.effective_message.reply_text("Responde al mensaje del usuario: /warn <razón>")
+        return await update.effective_message.reply_text("Responde al mensaje del usuario o usa: /warn <@usuario|user_id> <razón>")
 
-    reason = " ".join(context.args).strip() if context.args else None
+    reason = " ".join(args).strip() or None
     add_warn(chat_id, target_id, admin_id, reason)
+    learn_from_reply(update, spam=True)
 
     total = count_warns(chat_id, target_id)
     limit = get_warn_limit(chat_id)
@@ -624,22 +2437,30 @@ async def warns_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.effective_message.reply_text("❌ Solo admins.")
 
     chat_id = update.effective_chat.id
-    target_id = target_user_id_from_reply(update)
+    target_id, _ = resolve_target(update, context)
     if not target_id:
-        return await update.effective_message.reply_text("Responde al mensaje del usuario: /warns")
+        return await update.effective_message.reply_text("Responde al mensaje del usuario o usa: /warns <@usuario|user_id>")
 
-    total = count_warns(chat_id, target_id)
-    limit = get_warn_limit(chat_id)
-    rows = list_warns(chat_id, target_id, limit=10)
+    text, markup = warns_page(chat_id, target_id)
+    await update.effective_message.reply_text(text, reply_markup=markup)
 
-    if not rows:
-        return await update.effective_message.reply_text("✅ Este usuario no tiene warns.")
 
-    lines = [f"📋 Warns de {target_id}: {total}/{limit}\n"]
-    for r in rows:
-        reason = r["reason"] if r["reason"] else "(sin razón)"
-        lines.append(f"• #{r['id']} — {reason}")
-    await update.effective_message.reply_text("\n".join(lines))
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # en un grupo: solo admins y solo ese grupo (no se publica lo de otros grupos); en privado: todos
+    if is_group(update) and not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+    target_id, _ = resolve_target(update, context)
+    if not target_id:
+        return await update.effective_message.reply_text("Uso: /history <@usuario|user_id>")
+
+    chat_ids = await history_chats(context, update.effective_chat, update.effective_user.id, target_id, throttle=True)
+    if chat_ids is None:
+        return await update.effective_message.reply_text("⏳ Espera unos segundos antes de otra consulta de historial.")
+    if not chat_ids:
+        return await update.effective_message.reply_text("✅ Sin registros en chats donde seas admin.")
+
+    text, markup = history_page(target_id, chat_ids)
+    await update.effective_message.reply_text(text, reply_markup=markup)
 
 
 async def unwarn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -650,12 +2471,12 @@ async def unwarn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     admin_id = update.effective_user.id
-    target_id = target_user_id_from_reply(update)
+    target_id, _ = resolve_target(update, context)
     if not target_id:
-        return await update.effective_message.reply_text("Responde al mensaje del usuario: /unwarn")
+        return await update.effective_message.reply_text("Responde al mensaje del usuario o usa: /unwarn <@usuario|user_id>")
 
     if not remove_last_warn(chat_id, target_id):
-        return await update.effective_message.reply_text("✅ Ese usuario no tiene warns para quitar.")
+        return await update.effective_message.reply_text("✅ Ese usuario no tiene warns activos para quitar (los archivados se borran con /clearwarns).")
 
     total = count_warns(chat_id, target_id)
     limit = get_warn_limit(chat_id)
@@ -671,9 +2492,9 @@ async def clearwarns_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     admin_id = update.effective_user.id
-    target_id = target_user_id_from_reply(update)
+    target_id, _ = resolve_target(update, context)
     if not target_id:
-        return await update.effective_message.reply_text("Responde al mensaje del usuario: /clearwarns")
+        return await update.effective_message.reply_text("Responde al mensaje del usuario o usa: /clearwarns <@usuario|user_id>")
 
     deleted = clear_warns(chat_id, target_id)
     await update.effective_message.reply_text(f"🧹 Warns borrados: {deleted}\nUsuario: {target_id}")
@@ -688,15 +2509,17 @@ async def mute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     admin_id = update.effective_user.id
-    target_id = target_user_id_from_reply(update)
+    target_id, args = resolve_target(update, context)
     if not target_id:
-        return await update.effective_message.reply_text("Responde al mensaje del usuario: /mute <minutos> <razón opcional>")
+        return await update.effective_message.reply_text(
+            "Responde al mensaje del usuario o usa: /mute <@usuario|user_id> <minutos> <razón opcional>"
+        )
 
-    if not context.args or not context.args[0].isdigit():
-        return await update.effective_message.reply_text("Uso: /mute <minutos> <razón opcional>")
+    if not args or not args[0].isdigit():
+        return await update.effective_message.reply_text("Uso: /mute [@usuario|user_id] <minutos> <razón opcional>")
 
-    minutes = clamp(int(context.args[0]), 1, MAX_MUTE_MINUTES)
-    reason = " ".join(context.args[1:]).strip() if len(context.args) > 1 else None
+    minutes = clamp(int(args[0]), 1, MAX_MUTE_MINUTES)
+    reason = " ".join(args[1:]).strip() or None
     until_date = datetime.now(timezone.utc) + timedelta(minutes=minutes)
 
     try:
@@ -721,6 +2544,12 @@ async def mute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ),
             until_date=until_date,
         )
+        stats_add(chat_id, "mute")
+        revoke_and_cancel(context, chat_id, target_id, "mute")  # el mute nuevo reemplaza al anterior
+        sid = add_sanction(chat_id, target_id, "mute", admin_id, reason, until_date.timestamp(), context.bot.id)
+        scheduler = get_scheduler(context)
+        if scheduler:
+            scheduler.add(sid, until_date.timestamp())
         await update.effective_message.reply_text(f"🔇 Mute {minutes} min\nUsuario: {target_id}\nRazón: {reason or '(sin razón)'}")
         await send_modlog(context, chat_id, f"🔇 MUTE | admin {admin_id} → user {target_id} | {minutes} min | {reason or '(sin razón)'}")
     except Exception as e:
@@ -735,14 +2564,16 @@ async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     admin_id = update.effective_user.id
-    target_id = target_user_id_from_reply(update)
+    target_id, args = resolve_target(update, context)
     if not target_id:
-        return await update.effective_message.reply_text("Responde al mensaje del usuario: /ban <razón>")
+        return await update.effective_message.reply_text("Responde al mensaje del usuario o usa: /ban <@usuario|user_id> <razón>")
 
-    reason = " ".join(context.args).strip() if context.args else None
+    reason = " ".join(args).strip() or None
     try:
         await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
         add_ban(chat_id, target_id, admin_id, reason, source="manual")
+        revoke_and_cancel(context, chat_id, target_id, "ban")  # un tempban previo no debe levantarlo
+        learn_from_reply(update, spam=True)
         await update.effective_message.reply_text(f"⛔ Ban aplicado\nUsuario: {target_id}\nRazón: {reason or '(sin razón)'}")
         await send_modlog(context, chat_id, f"⛔ BAN | admin {admin_id} → user {target_id} | {reason or '(sin razón)'}")
     except Exception as e:
@@ -758,235 +2589,1634 @@ async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     admin_id = update.effective_user.id
 
-    # por reply o por user_id
-    target_id = target_user_id_from_reply(update)
+    # por reply, @username o user_id
+    target_id, args = resolve_target(update, context)
     if target_id is None:
-        if context.args and context.args[0].isdigit():
-            target_id = int(context.args[0])
-        else:
-            return await update.effective_message.reply_text("Uso: /unban <user_id>  (o respondiendo a un mensaje)")
+        return await update.effective_message.reply_text("Uso: /unban <@usuario|user_id>  (o respondiendo a un mensaje)")
 
-    reason = " ".join(context.args[1:]).strip() if (context.args and len(context.args) > 1) else None
+    reason = " ".join(args).strip() or None
 
     try:
         await context.bot.unban_chat_member(chat_id=chat_id, user_id=target_id)
         add_unban(chat_id, target_id, admin_id, reason)
+        revoke_and_cancel(context, chat_id, target_id, "ban")
         await update.effective_message.reply_text(f"✅ Unban aplicado\nUsuario: {target_id}\nRazón: {reason or '(sin razón)'}")
         await send_modlog(context, chat_id, f"✅ UNBAN | admin {admin_id} → user {target_id} | {reason or '(sin razón)'}")
     except Exception as e:
         await update.effective_message.reply_text(f"⚠️ No pude desbanear: {e}")
 
 
-# -------------------- BANNED WORDS ENFORCEMENT --------------------
-async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Detecta banned words, borra mensaje, da warn y autoban si corresponde."""
-    if not update.effective_chat or update.effective_chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
-        return
-    if not update.effective_message or not update.effective_message.text:
-        return
+async def tban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
 
     chat_id = update.effective_chat.id
-    user = update.effective_user
-    if not user:
-        return
-
-    # no castigar admins/owner
-    if await is_admin(update, context, user_id=user.id):
-        return
+    admin_id = update.effective_user.id
+    target_id, args = resolve_target(update, context)
+    if not target_id:
+        return await update.effective_message.reply_text(
+            "Responde al mensaje del usuario o usa: /tban <@usuario|user_id> <duración> <razón opcional>"
+        )
 
-    text = update.effective_message.text.lower()
-    words = bw_list(chat_id)
-    if not words:
-        return
+    seconds = parse_duration(args[0]) if args else None
+    if not seconds:
+        return await update.effective_message.reply_text("Uso: /tban [@usuario|user_id] <duración> <razón opcional>  (ej: 30m, 2h, 7d, 1w)")
 
-    hit = None
-    for w in words:
-        if w and w in text:
-            hit = w
-            break
-    if not hit:
-        return
+    seconds = clamp(seconds, 60, MAX_TBAN_SECONDS)
+    reason = " ".join(args[1:]).strip() or None
+    expires_at = time.time() + seconds
 
-    # 1) borrar mensaje
     try:
-        await update.effective_message.delete()
-    except Exception:
-        # si no se puede borrar, seguimos con warn (pero ideal tener permiso delete)
-        pass
+        await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
+        add_ban(chat_id, target_id, admin_id, reason, source="tempban")
+        revoke_and_cancel(context, chat_id, target_id, "ban")  # el tempban nuevo reemplaza al anterior
+        sid = add_sanction(chat_id, target_id, "ban", admin_id, reason, expires_at, context.bot.id)
+        scheduler = get_scheduler(context)
+        if scheduler:
+            scheduler.add(sid, expires_at)
+        await update.effective_message.reply_text(f"⛔ Tempban {format_remaining(seconds)}\nUsuario: {target_id}\nRazón: {reason or '(sin razón)'}")
+        await send_modlog(context, chat_id, f"⛔ TEMPBAN | admin {admin_id} → user {target_id} | {format_remaining(seconds)} | {reason or '(sin razón)'}")
+    except Exception as e:
+        await update.effective_message.reply_text(f"⚠️ No pude banear: {e}")
 
-    # 2) warn automático
-    reason = f"banned word: {hit}"
-    add_warn(chat_id, user.id, warned_by=0, reason=reason)  # 0 = automático
 
-    total = count_warns(chat_id, user.id)
-    limit = get_warn_limit(chat_id)
+async def unmute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
 
-    # aviso breve en el chat
-    try:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"🚫 Mensaje eliminado. ⚠️ Warn {total}/{limit} para {user.id} (palabra prohibida: {hit})",
+    chat_id = update.effective_chat.id
+    admin_id = update.effective_user.id
+    target_id, _ = resolve_target(update, context)
+    if not target_id:
+        return await update.effective_message.reply_text("Responde al mensaje del usuario o usa: /unmute <@usuario|user_id>")
+
+    try:
+        # vuelve a los permisos por defecto del grupo
+        chat = await context.bot.get_chat(chat_id)
+        await context.bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=target_id,
+            permissions=chat.permissions or ChatPermissions.all_permissions(),
+        )
+        revoke_and_cancel(context, chat_id, target_id, "mute")
+        await update.effective_message.reply_text(f"🔊 Unmute aplicado\nUsuario: {target_id}")
+        await send_modlog(context, chat_id, f"🔊 UNMUTE | admin {admin_id} → user {target_id}")
+    except Exception as e:
+        await update.effective_message.reply_text(f"⚠️ No pude quitar el mute: {e}")
+
+
+async def sanctions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    rows = list_active_sanctions(update.effective_chat.id)
+    if not rows:
+        return await update.effective_message.reply_text("✅ No hay sanciones temporales activas.")
+
+    now = time.time()
+    lines = ["⏱️ Sanciones activas\n"]
+    for r in rows:
+        label = "⛔ ban" if r["kind"] == "ban" else "🔇 mute"
+        lines.append(f"• #{r['id']} {label} | user {r['user_id']} | quedan {format_remaining(r['expires_at'] - now)} — {r['reason'] or '(sin razón)'}")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+async def noticettl_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    chat_id = update.effective_chat.id
+    if not context.args:
+        return await update.effective_message.reply_text(
+            f"🧹 Los avisos se borran a los {get_notice_ttl(chat_id)} s (0 = nunca).\nUso: /noticettl <segundos|off>"
         )
+    raw = context.args[0].lower()
+    if raw != "off" and not raw.isdigit():
+        return await update.effective_message.reply_text("Uso: /noticettl <segundos|off>")
+
+    ttl = 0 if raw == "off" else clamp(int(raw), 0, NOTICE_TTL_MAX)
+    set_notice_ttl(chat_id, ttl)
+    await update.effective_message.reply_text(f"✅ Avisos: {'no se borran' if not ttl else f'se borran a los {ttl} s'}.")
+
+
+async def trust_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    chat_id = update.effective_chat.id
+    policy = dict(get_trust_policy(chat_id))
+    optional = [name for name, _ in MESSAGE_FILTERS if name not in MANDATORY_FILTERS]
+    usage = f"Uso: /trust <filtro> <0-100> | /trust reset\nFiltros: {', '.join(optional)}"
+
+    if not context.args:
+        lines = [f"🤝 Miembros confiables (score ≥ {TRUST_THRESHOLD}): % de mensajes inspeccionados\n"]
+        lines += [f"• {name}: {policy.get(name, 100)}%" for name in optional]
+        lines.append(f"• {', '.join(sorted(MANDATORY_FILTERS))}: siempre")
+        target_id = target_user_id_from_reply(update)
+        if target_id:
+            score = TRUST.get(chat_id, target_id).score(time.time())
+            lines.append(f"\nUsuario {target_id}: score {score}{' (confiable)' if score >= TRUST_THRESHOLD else ''}")
+        lines.append("\n" + usage)
+        return await update.effective_message.reply_text("\n".join(lines))
+
+    if context.args[0].lower() == "reset":
+        set_trust_policy(chat_id, {})
+        return await update.effective_message.reply_text("✅ Todos los filtros inspeccionan a todos.")
+
+    name = context.args[0].lower()
+    if name in MANDATORY_FILTERS:
+        return await update.effective_message.reply_text(f"❌ {name} es obligatorio para todos.")
+    if name not in optional or len(context.args) < 2 or not context.args[1].isdigit():
+        return await update.effective_message.reply_text(usage)
+
+    pct = clamp(int(context.args[1]), 0, 100)
+    if pct == 100:
+        policy.pop(name, None)
+    else:
+        policy[name] = pct
+    set_trust_policy(chat_id, policy)
+    what = "se salta" if pct == 0 else f"se inspecciona el {pct}%"
+    await update.effective_message.reply_text(f"✅ {name}: para miembros confiables {what}.")
+
+
+async def slow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+    if not PROFILER:
+        return await update.effective_message.reply_text("🐌 Profiling desactivado (definir PROFILE_SLOW_MS).")
+
+    reports = await asyncio.to_thread(PROFILER.load_reports)
+    rows = slow_paths(reports)
+    if not rows:
+        return await update.effective_message.reply_text(
+            f"🐌 Sin updates de más de {PROFILE_SLOW_MS} ms en los últimos {len(reports)} reportes."
+        )
+    lines = [f"🐌 Caminos lentos (> {PROFILE_SLOW_MS} ms, todo el proceso)\n"]
+    for path, n, avg, worst in rows[:SLOW_TOP]:
+        lines.append(f"• {path}: {n}× · prom {avg:.0f} ms · máx {worst:.0f} ms")
+    latest = next(r for r in reports if r.get("slow"))
+    lines.append(f"\nÚltimo ({latest['handler']}, {latest['elapsed_ms']:.0f} ms):")
+    lines += [f"  {sp['kind']}:{sp['name']} ×{sp['count']} {sp['ms']:.0f} ms" for sp in latest["spans"][:5]]
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+async def purge_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    msg = update.effective_message
+    chat_id = update.effective_chat.id
+    usage = "Uso: /purge (reply: desde ese mensaje hasta aquí) | /purge user (reply) | /purge user <@usuario|user_id>"
+
+    if context.args and context.args[0].lower() == "user":
+        target_id, _ = resolve_target(update, context, context.args[1:])
+        if not target_id:
+            return await msg.reply_text(usage)
+        ids = RECENT.of_user(chat_id, target_id)
+        what = f"de {target_id}"
+    elif msg.reply_to_message and not context.args:
+        first = msg.reply_to_message.message_id
+        ids = sorted(set(RECENT.in_range(chat_id, first, msg.message_id)) | {first})
+        what = f"desde {first}"
+    else:
+        return await msg.reply_text(usage)
+
+    failed = await purge_messages(context, chat_id, ids + [msg.message_id])
+    deleted = max(len(ids) - failed, 0)
+    await send_notice(context, chat_id, removed=deleted, text=f"🧹 {deleted} mensajes purgados {what}.")
+    await send_modlog(context, chat_id, f"🧹 PURGE | admin {update.effective_user.id} | {deleted} msgs {what}")
+
+
+async def heuristics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    msg = update.effective_message
+    chat_id = update.effective_chat.id
+    usage = (
+        "Uso: /heuristics action <off|log|delete|warn>\n"
+        f"/heuristics <{'|'.join(HEURISTIC_DEFAULTS)}> <valor|off>\n"
+        f"/heuristics scripts <{','.join(SCRIPT_NAMES.values())}>\n"
+        "/heuristics reset · /heuristics (reply) para medir un mensaje"
+    )
+
+    if not context.args:
+        config = get_heuristics_config(chat_id)
+        lines = [
+            f"🔤 Heurísticas: {config['action']}",
+            f"• scripts permitidos: {', '.join(sorted(config['scripts'])) or '—'}",
+        ]
+        lines += [f"• {m}: {'off' if config[m] is None else config[m]}" for m in HEURISTIC_DEFAULTS]
+        target = msg.reply_to_message
+        if target and (target.text or target.caption):
+            texts, urls = message_texts(target)
+            lines.append("\n" + format_profile(text_profile("\n".join(texts), len(urls))))
+        lines.append("\n" + usage)
+        return await msg.reply_text("\n".join(lines))
+
+    key = context.args[0].lower()
+    value = context.args[1].lower() if len(context.args) > 1 else ""
+    if key == "reset":
+        reset_chat_options(chat_id, "heuristics")
+        return await msg.reply_text("✅ Heurísticas desactivadas y umbrales por defecto.")
+    if key == "action" and value in HEURISTIC_ACTIONS:
+        pass
+    elif key == "scripts" and value and set(value.split(",")) <= set(SCRIPT_NAMES.values()):
+        pass
+    elif key in HEURISTIC_DEFAULTS and value:
+        try:
+            value = "off" if value == "off" else str(max(float(value), 0))
+        except ValueError:
+            return await msg.reply_text(usage)
+    else:
+        return await msg.reply_text(usage)
+
+    set_chat_option(chat_id, "heuristics", key, value)
+    await msg.reply_text(f"✅ Heurísticas: {key} = {value}")
+
+
+async def clf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    msg = update.effective_message
+    chat_id = update.effective_chat.id
+    usage = (
+        "Uso: /clf spam|ham (reply) para etiquetar\n"
+        "/clf action <off|log|warn> · /clf flag <0-1> · /clf warn <0-1> · /clf model <chat|shared>\n"
+        "/clf reset · /clf (reply) para ver la probabilidad de un mensaje"
+    )
+
+    if not context.args:
+        config = get_classifier_config(chat_id)
+        model_id = CLASSIFIER.model_id_for(chat_id)
+        model = CLASSIFIER.get(model_id)
+        lines = [
+            f"🧠 Clasificador: {config['action']} · modelo {'compartido' if model_id == CLF_SHARED_MODEL else 'del grupo'}",
+            f"• ejemplos: {model.docs[1]} spam / {model.docs[0]} ham"
+            + ("" if model.ready() else f" (puntúa desde {CLF_MIN_DOCS} de cada uno)"),
+            f"• flag al mod-log ≥ {config['flag']} · borrar + warn ≥ {config['warn']}",
+        ]
+        target = msg.reply_to_message
+        if target and (target.text or target.caption or target.poll):
+            texts, _ = message_texts(target)
+            p = CLASSIFIER.spam_probability(chat_id, "\n".join(texts).lower())
+            lines.append("\n" + (f"Probabilidad de spam: {p:.1%}" if p is not None else "Modelo sin datos suficientes."))
+        lines.append("\n" + usage)
+        return await msg.reply_text("\n".join(lines))
+
+    key = context.args[0].lower()
+    value = context.args[1].lower() if len(context.args) > 1 else ""
+    if key in ("spam", "ham"):
+        if not learn_from_reply(update, spam=key == "spam"):
+            return await msg.reply_text("Responde a un mensaje con texto: /clf spam | /clf ham")
+        return await msg.reply_text(f"✅ Aprendido como {key}.")
+    if key == "reset":
+        reset_chat_options(chat_id, "classifier")
+        return await msg.reply_text("✅ Clasificador desactivado y umbrales por defecto (el modelo se conserva).")
+    if key == "action" and value in ("off", "log", "warn"):
+        pass
+    elif key == "model" and value in ("chat", "shared"):
+        pass
+    elif key in ("flag", "warn") and value:
+        try:
+            value = str(clamp(float(value), 0.5, 1.0))
+        except ValueError:
+            return await msg.reply_text(usage)
+    else:
+        return await msg.reply_text(usage)
+
+    set_chat_option(chat_id, "classifier", key, value)
+    await msg.reply_text(f"✅ Clasificador: {key} = {value}")
+
+
+async def whois_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    chat_id = update.effective_chat.id
+    target_id, _ = resolve_target(update, context)
+    if not target_id:
+        hint = " (ese @usuario todavía no escribió donde está el bot)" if context.args and context.args[0].startswith("@") else ""
+        return await update.effective_message.reply_text(f"Uso: /whois <@usuario|user_id> o respondiendo{hint}")
+
+    seen = USERS.last_seen(chat_id, target_id)
+    when = f"hace {format_remaining(time.time() - seen)}" if seen else "nunca (desde que se lleva registro)"
+    name = USERS.username_of(target_id)
+    alias = f"@{name[0]} (visto con ese @ hace {format_remaining(time.time() - name[1])})" if name else "(sin @ conocido)"
+    await update.effective_message.reply_text(
+        f"👤 Usuario {target_id} {alias}\nÚltimo mensaje en este grupo: {when}\nWarns: {count_warns(chat_id, target_id)}/{get_warn_limit(chat_id)}"
+    )
+
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    lines = ["📈 Métricas del bot\n"]
+    lines += [f"• {k}: {v}" for k, v in sorted(METRICS.items())]
+    limiter = context.bot.rate_limiter
+    if isinstance(limiter, BotRateLimiter):
+        lines.append(f"• api_calls_total: {sum(limiter.calls.values())}")
+        lines.append(f"• api_throttled_total: {limiter.throttled}")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    window = context.args[0].lower() if context.args else "24h"
+    if window not in STATS_WINDOWS:
+        return await update.effective_message.reply_text("Uso: /stats [24h|7d|30d]")
+
+    stats = get_stats(update.effective_chat.id, STATS_WINDOWS[window])
+    await update.effective_message.reply_text(stats_text(stats, window))
+
+
+async def blockmedia_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    chat_id = update.effective_chat.id
+    admin_id = update.effective_user.id
+    reply = update.effective_message.reply_to_message
+    media = media_of(reply) if reply else None
+    if not media:
+        return await update.effective_message.reply_text("Responde a un sticker / GIF / foto / video: /blockmedia")
+
+    kind, unique_id, thumb = media
+    phash = await media_phash(context.bot, unique_id, thumb)
+    if not media_block_add(chat_id, unique_id, kind, phash, admin_id):
+        return await update.effective_message.reply_text("⚠️ Ese media ya estaba bloqueado.")
+
+    try:
+        await reply.delete()
     except Exception:
         pass
+    extra = " (+ similares)" if phash is not None else ""
+    await update.effective_message.reply_text(f"✅ {kind} bloqueado{extra}.")
+    await send_modlog(context, chat_id, f"🖼️ MEDIA BLOCK | admin {admin_id} | {kind} {unique_id}{extra}")
+
+
+async def unblockmedia_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group(update):
+        return await update.effective_message.reply_text("Solo en grupos.")
+    if not await is_admin(update, context):
+        return await update.effective_message.reply_text("❌ Solo admins.")
+
+    chat_id = update.effective_chat.id
+    reply = update.effective_message.reply_to_message
+    media = media_of(reply) if reply else None
+    if not media:
+        return await update.effective_message.reply_text("Responde al media: /unblockmedia")
+
+    if not media_block_remove(chat_id, media[1]):
+        return await update.effective_message.reply_text("⚠️ Ese media no estaba bloqueado.")
+    await update.effective_message.reply_text(f"✅ {media[0]} desbloqueado.")
+    await send_modlog(context, chat_id, f"🖼️ MEDIA UNBLOCK | admin {update.effective_user.id} | {media[0]} {media[1]}")
+
+
+# -------------------- INGESTA (TEXTO, CAPTIONS, EDICIONES, ENCUESTAS) --------------------
+class MessageContext:
+    """Todo lo inspeccionable de un update, extraído una sola vez y compartido por los filtros."""
+    __slots__ = ("message", "chat_id", "user_id", "is_edit", "raw_text", "text", "urls", "media")
+
+    def __init__(self, message, chat_id: int, user_id: int, is_edit: bool, raw_text: str, urls: list[str], media):
+        self.message = message
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.is_edit = is_edit
+        self.raw_text = raw_text
+        self.text = raw_text.lower()
+        self.urls = urls
+        self.media = media
+
+
+class Verdict:
+    """Resultado de un filtro: qué regla saltó y cómo reportarlo."""
+    __slots__ = ("rule", "reason", "notice_detail", "modlog_label", "stat_key", "action")
+
+    def __init__(self, rule: str, reason: str, notice_detail: str, modlog_label: str, stat_key: str = "",
+                 action: str = "warn"):
+        self.rule = rule
+        self.reason = reason
+        self.notice_detail = notice_detail
+        self.modlog_label = modlog_label
+        self.stat_key = stat_key
+        self.action = action  # log | delete | warn (borrar + warn + autoban)
+
+
+# último texto visto por mensaje: una edición solo se re-escanea si el texto cambió
+SEEN_TEXT: "OrderedDict[tuple[int, int], int]" = OrderedDict()
+
+
+def message_texts(msg) -> tuple[list[str], list[str]]:
+    """(textos, urls): text/caption, pregunta y opciones de encuesta, URLs de entidades."""
+    texts, urls, hidden = [], [], []
+    if msg.text:
+        texts.append(msg.text)
+        entities = msg.parse_entities(["url", "text_link"])
+    elif msg.caption:
+        texts.append(msg.caption)
+        entities = msg.parse_caption_entities(["url", "text_link"])
+    else:
+        entities = {}
+    for ent, value in entities.items():
+        if ent.type == "text_link":
+            hidden.append(ent.url)  # el destino no aparece en el texto visible
+        urls.append(ent.url if ent.type == "text_link" else value)
+    if msg.poll:
+        texts.append(msg.poll.question)
+        texts.extend(o.text for o in msg.poll.options)
+    texts.extend(hidden)
+    return texts, urls
+
+
+def build_message_context(update: Update) -> Optional[MessageContext]:
+    msg = update.effective_message
+    user = update.effective_user
+    if not msg or not user or not is_group(update):
+        return None
+
+    texts, urls = message_texts(msg)
+    media = media_of(msg)
+    if not texts and not media:
+        return None
+
+    raw_text = "\n".join(texts)
+    is_edit = update.edited_message is not None
+    key = (update.effective_chat.id, msg.message_id)
+    digest = hash(raw_text)
+    if is_edit and SEEN_TEXT.get(key) == digest:
+        return None  # edición sin cambios en el texto (p. ej. solo reacciones/markup)
+    SEEN_TEXT[key] = digest
+    SEEN_TEXT.move_to_end(key)
+    while len(SEEN_TEXT) > SEEN_TEXT_CACHE_SIZE:
+        SEEN_TEXT.popitem(last=False)
+
+    return MessageContext(msg, update.effective_chat.id, user.id, is_edit, raw_text, urls, media)
+
+
+# -------------------- CONFIANZA (MIEMBROS ESTABLECIDOS) --------------------
+class MemberTrust:
+    __slots__ = ("messages", "first_seen", "warns", "last_warn_at", "dirty")
+
+    def __init__(self, messages: int, first_seen: float, warns: int, last_warn_at: Optional[float]):
+        self.messages = messages
+        self.first_seen = first_seen
+        self.warns = warns
+        self.last_warn_at = last_warn_at
+        self.dirty = False
+
+    def score(self, now: float) -> int:
+        """0-100: mitad por mensajes limpios, mitad por antigüedad, menos los warns."""
+        if self.last_warn_at and now - self.last_warn_at < TRUST_WARN_COOLDOWN_DAYS * 86400:
+            return 0
+        days = (now - self.first_seen) / 86400
+        score = 50 * min(self.messages / TRUST_FULL_MESSAGES, 1) + 50 * min(days / TRUST_FULL_DAYS, 1)
+        return clamp(int(score) - TRUST_WARN_PENALTY * self.warns, 0, 100)
+
+
+class TrustTracker:
+    """
+    Score de confianza por (chat, usuario) en memoria (LRU). Los cambios se marcan sucios y
+    flush() los escribe en member_trust en un solo executemany; las entradas sucias que salen
+    del LRU se guardan igual en el siguiente flush.
+    """
+
+    def __init__(self, max_size: int = TRUST_CACHE_SIZE):
+        self.max_size = max_size
+        self.members: "OrderedDict[tuple[int, int], MemberTrust]" = OrderedDict()
+        self._evicted: list[tuple] = []
+
+    def get(self, chat_id: int, user_id: int) -> MemberTrust:
+        key = (chat_id, user_id)
+        member = self.members.get(key)
+        if member is not None:
+            self.members.move_to_end(key)
+            return member
+        row = load_member_trust(chat_id, user_id)
+        if row:
+            member = MemberTrust(row["messages"], row["first_seen"], row["warns"], row["last_warn_at"])
+        else:
+            member = MemberTrust(0, time.time(), *warn_summary(chat_id, user_id))
+            member.dirty = True
+        self.members[key] = member
+        while len(self.members) > self.max_size:
+            old_key, old = self.members.popitem(last=False)
+            if old.dirty:
+                self._evicted.append(self._row(old_key, old))
+        return member
+
+    def note_message(self, chat_id: int, user_id: int):
+        member = self.get(chat_id, user_id)
+        member.messages += 1
+        member.dirty = True
+
+    def note_warn(self, chat_id: int, user_id: int):
+        member = self.get(chat_id, user_id)
+        member.warns += 1
+        member.last_warn_at = time.time()
+        member.dirty = True
+
+    def is_trusted(self, chat_id: int, user_id: int) -> bool:
+        return self.get(chat_id, user_id).score(time.time()) >= TRUST_THRESHOLD
+
+    @staticmethod
+    def _row(key: tuple[int, int], m: MemberTrust) -> tuple:
+        return (key[0], key[1], m.messages, m.first_seen, m.warns, m.last_warn_at)
+
+    def pending(self) -> list[tuple]:
+        """Filas a persistir; las entradas quedan limpias (el snapshot se toma en el event loop)."""
+        rows, self._evicted = self._evicted, []
+        for key, m in self.members.items():
+            if m.dirty:
+                rows.append(self._row(key, m))
+                m.dirty = False
+        return rows
+
+    def flush(self) -> int:
+        rows = self.pending()
+        if rows:
+            save_member_trust(rows)
+        return len(rows)
+
+
+TRUST = TrustTracker()
+
+
+def inspection_skips(chat_id: int, user_id: int) -> frozenset:
+    """Filtros que no se corren para este mensaje (solo miembros confiables, nunca los obligatorios)."""
+    policy = get_trust_policy(chat_id)
+    if not policy or not TRUST.is_trusted(chat_id, user_id):
+        return frozenset()
+    METRICS["trusted_messages_total"] += 1
+    return frozenset(
+        name for name, pct in policy.items()
+        if name not in MANDATORY_FILTERS and random.random() * 100 >= pct
+    )
 
-    await send_modlog(context, chat_id, f"🚫 BANNED WORD | user {user.id} | hit '{hit}' | warn {total}/{limit}")
 
-    # 3) autoban si llega al límite
-    # actor_id=0 (automático) y source='banned_word'
-    await maybe_autoban_after_warn(update, context, chat_id, user.id, actor_id=0, source="banned_word")
+async def trust_flush_loop():
+    while True:
+        await asyncio.sleep(TRUST_FLUSH_SECONDS)
+        try:
+            rows = TRUST.pending()
+            if rows:
+                await asyncio.to_thread(save_member_trust, rows)
+        except Exception as e:
+            print(f"⚠️ Error guardando confianza: {e}")
+
+
+# -------------------- HEURÍSTICAS (SCRIPTS, EMOJI, INVISIBLES) --------------------
+# Cada carácter se traduce a un código de clase con str.translate (tabla precalculada) y
+# cada código se cuenta con str.count: todo en C, sin bucles en Python por carácter.
+# Mayúscula = script con caja (A latin, C cyrillic, G greek). Las letras de scripts sin rango
+# propio (bengalí, georgiano, etíope, letras matemáticas 𝐀…) van a "x" (other): cuentan como
+# extranjeras. El resto sin entrada en la tabla queda tal cual ("otros"; el ASCII está todo
+# mapeado, no hay choques).
+SCRIPT_RANGES = (
+    # (desde, hasta, código) — orden importa: los posteriores pisan a los anteriores
+    (0x00C0, 0x024F, "a"), (0x1E00, 0x1EFF, "a"),
+    (0x0370, 0x03FF, "g"), (0x1F00, 0x1FFF, "g"),
+    (0x0400, 0x052F, "c"),
+    (0x0590, 0x05FF, "h"),
+    (0x0600, 0x06FF, "r"), (0x0750, 0x077F, "r"), (0xFB50, 0xFDFF, "r"), (0xFE70, 0xFEFF, "r"),
+    (0x0900, 0x097F, "d"),
+    (0x0E00, 0x0E7F, "t"),
+    (0x3040, 0x30FF, "j"),
+    (0x3400, 0x4DBF, "k"), (0x4E00, 0x9FFF, "k"),
+    (0x1100, 0x11FF, "o"), (0x3130, 0x318F, "o"), (0xAC00, 0xD7AF, "o"),
+    (0x2600, 0x27BF, "e"), (0x1F000, 0x1FAFF, "e"),
+    (0xFE00, 0xFE0F, "m"), (0x200D, 0x200D, "m"),  # selectores de variante y ZWJ: parte de un emoji
+    (0x00AD, 0x00AD, "i"), (0x034F, 0x034F, "i"), (0x115F, 0x1160, "i"), (0x180E, 0x180E, "i"),
+    (0x200B, 0x200C, "i"), (0x200E, 0x200F, "i"), (0x202A, 0x202E, "i"), (0x2060, 0x2064, "i"),
+    (0x2066, 0x2069, "i"), (0x2800, 0x2800, "i"), (0x3164, 0x3164, "i"), (0xFEFF, 0xFEFF, "i"),
+    (0xFFA0, 0xFFA0, "i"),
+)
+SCRIPT_NAMES = {
+    "a": "latin", "c": "cyrillic", "g": "greek", "h": "hebrew", "r": "arabic", "d": "devanagari",
+    "t": "thai", "j": "kana", "k": "han", "o": "hangul", "x": "other",
+}
+CASED_CODES = frozenset("acg")
+PROFILE_CODES = "aAcCgGhrdtjkoxeim "  # los que text_profile necesita contar
+
+
+def build_charclass_table() -> dict[int, str]:
+    table = {}
+    for cp in range(128):
+        ch = chr(cp)
+        if ch.isalpha():
+            table[cp] = "A" if ch.isupper() else "a"
+        elif ch.isdigit():
+            table[cp] = "n"
+        elif ch.isspace():
+            table[cp] = " "
+        else:
+            table[cp] = "p"
+    for start, end, code in SCRIPT_RANGES:
+        for cp in range(start, end + 1):
+            ch = chr(cp)
+            if code in CASED_CODES and not ch.isalpha():
+                table.pop(cp, None)  # signos dentro del bloque: "otros"
+            elif code in CASED_CODES and ch.isupper():
+                table[cp] = code.upper()
+            else:
+                table[cp] = code
+    for cp in range(128, sys.maxunicode + 1):
+        if cp not in table and chr(cp).isalpha():
+            table[cp] = "x"
+    return table
+
+
+CHARCLASS_TABLE = build_charclass_table()
+
+
+def text_profile(text: str, links: int = 0) -> dict:
+    """Histograma de scripts + proporciones de emoji, invisibles, links y mayúsculas (una pasada)."""
+    classes = text.translate(CHARCLASS_TABLE)
+    counts = {code: classes.count(code) for code in PROFILE_CODES}
+    scripts = {}
+    for code, name in SCRIPT_NAMES.items():
+        n = counts.get(code, 0) + (counts.get(code.upper(), 0) if code in CASED_CODES else 0)
+        if n:
+            scripts[name] = n
+    letters = sum(scripts.values())
+    cased = sum(counts.get(c, 0) + counts.get(c.upper(), 0) for c in CASED_CODES)
+    upper = sum(counts.get(c.upper(), 0) for c in CASED_CODES)
+    visible = len(text) - counts.get(" ", 0) - counts.get("i", 0) - counts.get("m", 0)
+    return {
+        "visible": visible,
+        "scripts": scripts,
+        "letters": letters,
+        "emoji": counts.get("e", 0) / visible if visible else 0.0,
+        "invisible": counts.get("i", 0),
+        "links": 100 * links / visible if visible else 0.0,
+        "upper": upper / cased if cased else 0.0,
+        "cased": cased,
+    }
+
+
+def heuristic_hits(profile: dict, config: dict) -> list[tuple[str, float]]:
+    """Métricas que pasan su umbral: [(métrica, valor)]."""
+    hits = []
+    if config["invisible"] is not None and profile["invisible"] >= config["invisible"]:
+        hits.append(("invisible", profile["invisible"]))
+    if profile["visible"] < HEURISTIC_MIN_CHARS:
+        return hits
+    if config["foreign"] is not None and profile["letters"]:
+        foreign = sum(n for name, n in profile["scripts"].items() if name not in config["scripts"]) / profile["letters"]
+        if foreign >= config["foreign"]:
+            hits.append(("foreign", foreign))
+    for metric in ("emoji", "links"):
+        if config[metric] is not None and profile[metric] >= config[metric]:
+            hits.append((metric, profile[metric]))
+    if config["upper"] is not None and profile["cased"] >= HEURISTIC_MIN_CHARS and profile["upper"] >= config["upper"]:
+        hits.append(("upper", profile["upper"]))
+    return hits
+
+
+def format_profile(profile: dict) -> str:
+    scripts = ", ".join(f"{name} {n}" for name, n in sorted(profile["scripts"].items(), key=lambda kv: -kv[1])) or "—"
+    return (
+        f"visibles {profile['visible']} · scripts: {scripts}\n"
+        f"emoji {profile['emoji']:.0%} · invisibles {profile['invisible']} · "
+        f"links/100 {profile['links']:.1f} · mayúsculas {profile['upper']:.0%}"
+    )
 
 
-# -------------------- CALLBACKS (MENÚ COMPLETO + PM) --------------------
-async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    if not query:
+# -------------------- CLASIFICADOR (NAIVE BAYES INCREMENTAL) --------------------
+def clf_features(text: str) -> list[int]:
+    """Uni y bigramas de palabras, hasheados con crc32 a CLF_BUCKETS (sin repetir)."""
+    tokens = WORD_RE.findall(text)[:CLF_MAX_TOKENS]
+    mask = CLF_BUCKETS - 1
+    feats = {zlib.crc32(tok.encode()) & mask for tok in tokens}
+    feats.update(zlib.crc32(f"{a} {b}".encode()) & mask for a, b in zip(tokens, tokens[1:]))
+    return list(feats)
+
+
+class NaiveBayes:
+    """Multinomial NB con suavizado de Laplace; contadores en dos array('I') (ham, spam)."""
+    __slots__ = ("counts", "docs", "tokens", "dirty")
+
+    def __init__(self, ham: Optional[array] = None, spam: Optional[array] = None,
+                 docs: tuple[int, int] = (0, 0), tokens: tuple[int, int] = (0, 0)):
+        self.counts = (ham or array("I", bytes(4 * CLF_BUCKETS)), spam or array("I", bytes(4 * CLF_BUCKETS)))
+        self.docs = list(docs)
+        self.tokens = list(tokens)
+        self.dirty = False
+
+    def learn(self, feats: list[int], spam: bool):
+        counts = self.counts[spam]
+        for f in feats:
+            counts[f] += 1
+        self.docs[spam] += 1
+        self.tokens[spam] += len(feats)
+        self.dirty = True
+
+    def ready(self) -> bool:
+        return min(self.docs) >= CLF_MIN_DOCS
+
+    def spam_probability(self, feats: list[int]) -> float:
+        ham, spam = self.counts
+        score = math.log((self.docs[1] + 1) / (self.docs[0] + 1))
+        score += len(feats) * math.log((self.tokens[0] + CLF_BUCKETS) / (self.tokens[1] + CLF_BUCKETS))
+        for f in feats:
+            score += math.log((spam[f] + 1) / (ham[f] + 1))
+        return 1 / (1 + math.exp(-clamp(score, -50, 50)))
+
+
+class ClassifierStore:
+    """
+    Modelos en memoria (LRU de CLF_MODELS_MAX) y ejemplos pendientes; flush() los escribe juntos.
+    Un modelo sucio que sale del LRU espera en `_evicted` al próximo flush (nunca se escribe
+    desde el event loop) y, si se vuelve a pedir antes, se recupera de ahí.
+    """
+
+    def __init__(self):
+        self.models: "OrderedDict[int, NaiveBayes]" = OrderedDict()
+        self._evicted: dict[int, NaiveBayes] = {}
+        self._examples: list[tuple] = []
+
+    def get(self, model_id: int) -> NaiveBayes:
+        model = self.models.get(model_id)
+        if model is not None:
+            self.models.move_to_end(model_id)
+            return model
+        model = self._evicted.pop(model_id, None)
+        if model is None:
+            model = self._load(model_id)
+        self.models[model_id] = model
+        while len(self.models) > CLF_MODELS_MAX:
+            old_id, old = self.models.popitem(last=False)
+            if old.dirty:
+                self._evicted[old_id] = old
+        return model
+
+    @staticmethod
+    def _load(model_id: int) -> NaiveBayes:
+        row = load_classifier_model(model_id)
+        if not row:
+            return NaiveBayes()
+        ham, spam = array("I"), array("I")
+        ham.frombytes(row["ham"])
+        spam.frombytes(row["spam"])
+        return NaiveBayes(ham, spam, (row["ham_docs"], row["spam_docs"]), (row["ham_tokens"], row["spam_tokens"]))
+
+    def model_id_for(self, chat_id: int) -> int:
+        return CLF_SHARED_MODEL if get_classifier_config(chat_id)["model"] == "shared" else chat_id
+
+    def learn(self, chat_id: int, text: str, spam: bool) -> bool:
+        feats = clf_features(text)
+        if not feats:
+            return False
+        model_id = self.model_id_for(chat_id)
+        self.get(model_id).learn(feats, spam)
+        self._examples.append((model_id, int(spam), array("I", feats).tobytes(), datetime.now(timezone.utc).isoformat()))
+        METRICS["clf_learned_spam_total" if spam else "clf_learned_ham_total"] += 1
+        return True
+
+    def spam_probability(self, chat_id: int, text: str) -> Optional[float]:
+        """None si el modelo todavía no tiene ejemplos suficientes."""
+        model = self.get(self.model_id_for(chat_id))
+        if not model.ready():
+            return None
+        feats = clf_features(text)
+        return model.spam_probability(feats) if feats else None
+
+    @staticmethod
+    def _row(model_id: int, m: NaiveBayes) -> tuple:
+        return (model_id, m.docs[0], m.docs[1], m.tokens[0], m.tokens[1], m.counts[0].tobytes(), m.counts[1].tobytes())
+
+    def pending(self) -> tuple[list[tuple], list[tuple]]:
+        models = [self._row(model_id, m) for model_id, m in self._evicted.items()]
+        self._evicted = {}
+        for model_id, m in self.models.items():
+            if m.dirty:
+                models.append(self._row(model_id, m))
+                m.dirty = False
+        examples, self._examples = self._examples, []
+        return models, examples
+
+    def flush(self):
+        models, examples = self.pending()
+        if models or examples:
+            save_classifier(models, examples)
+
+
+CLASSIFIER = ClassifierStore()
+
+
+def learn_from_reply(update: Update, spam: bool) -> bool:
+    """Entrena con el mensaje respondido por un admin (/warn, /ban, /clf)."""
+    target = update.effective_message.reply_to_message if update.effective_message else None
+    if not target or not (target.text or target.caption or target.poll):
+        return False
+    texts, _ = message_texts(target)
+    return CLASSIFIER.learn(update.effective_chat.id, "\n".join(texts).lower(), spam)
+
+
+async def classifier_flush_loop():
+    while True:
+        await asyncio.sleep(CLF_FLUSH_SECONDS)
+        try:
+            models, examples = CLASSIFIER.pending()
+            if models or examples:
+                await asyncio.to_thread(save_classifier, models, examples)
+        except Exception as e:
+            print(f"⚠️ Error guardando clasificador: {e}")
+
+
+# -------------------- FILTROS (BANNED WORDS, MEDIA) --------------------
+async def check_banned_words(ctx: MessageContext, context: ContextTypes.DEFAULT_TYPE) -> Optional[Verdict]:
+    if not ctx.text:
+        return None
+    matcher = bw_matcher(ctx.chat_id)
+    if not matcher:
+        return None
+    m = matcher.search(ctx.text)
+    if not m:
+        return None
+    hit = m.group(0)
+    return Verdict(
+        "banned_word",
+        reason=f"banned word: {hit}",
+        notice_detail=f"palabra prohibida: {hit}",
+        modlog_label=f"BANNED WORD | user {ctx.user_id} | hit '{hit}'",
+        stat_key=hit,
+    )
+
+
+async def check_heuristics(ctx: MessageContext, context: ContextTypes.DEFAULT_TYPE) -> Optional[Verdict]:
+    if not ctx.raw_text:
+        return None
+    config = get_heuristics_config(ctx.chat_id)
+    if config["action"] == "off":
+        return None
+    hits = heuristic_hits(text_profile(ctx.raw_text, len(ctx.urls)), config)
+    if not hits:
+        return None
+    detail = ", ".join(f"{metric} {value:.2f}" if isinstance(value, float) else f"{metric} {value}" for metric, value in hits)
+    return Verdict(
+        "heuristics",
+        reason=f"heuristics: {detail}",
+        notice_detail=f"heurística: {detail}",
+        modlog_label=f"HEURISTICS | user {ctx.user_id} | {detail}",
+        stat_key=hits[0][0],
+        action=config["action"],
+    )
+
+
+async def check_classifier(ctx: MessageContext, context: ContextTypes.DEFAULT_TYPE) -> Optional[Verdict]:
+    if not ctx.text:
+        return None
+    config = get_classifier_config(ctx.chat_id)
+    if config["action"] == "off":
+        return None
+    p = CLASSIFIER.spam_probability(ctx.chat_id, ctx.text)
+    if p is None:
+        return None
+    if config["action"] == "warn" and p >= config["warn"]:
+        action = "warn"
+    elif p >= config["flag"]:
+        action = "log"
+    else:
+        return None
+    return Verdict(
+        "classifier",
+        reason=f"classifier: spam {p:.3f}",
+        notice_detail=f"spam ({p:.0%})",
+        modlog_label=f"CLASSIFIER | user {ctx.user_id} | spam {p:.3f}",
+        stat_key="delete" if action == "warn" else "flag",
+        action=action,
+    )
+
+
+async def check_media(ctx: MessageContext, context: ContextTypes.DEFAULT_TYPE) -> Optional[Verdict]:
+    if not ctx.media:
+        return None
+    detail = await media_hit(context.bot, ctx.chat_id, ctx.media)
+    if not detail:
+        return None
+    return Verdict(
+        "media",
+        reason=f"media: {detail}",
+        notice_detail=detail,
+        modlog_label=f"MEDIA | user {ctx.user_id} | {detail} {ctx.media[1]}",
+        stat_key=ctx.media[0],
+    )
+
+
+# orden = prioridad; el primero que devuelve Verdict gana
+MESSAGE_FILTERS = (
+    ("banned_words", check_banned_words),
+    ("heuristics", check_heuristics),
+    ("media", check_media),
+    ("classifier", check_classifier),
+)
+
+# regla -> métrica de /stats
+RULE_STATS = {"banned_word": "bw_hit", "media": "media_hit", "heuristics": "heuristic_hit", "classifier": "clf_hit"}
+
+
+async def run_filters(ctx: MessageContext, context: ContextTypes.DEFAULT_TYPE,
+                      skip: frozenset = frozenset()) -> Optional[Verdict]:
+    for name, check in MESSAGE_FILTERS:
+        if name in skip:
+            METRICS["filters_skipped_total"] += 1
+            continue
+        with span("filter", name):
+            verdict = await check(ctx, context)
+        if verdict:
+            return verdict
+    return None
+
+
+async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Una sola etapa para mensajes, captions, ediciones y encuestas: filtros → borrar + warn + autoban."""
+    ctx = build_message_context(update)
+    if not ctx:
         return
-    await query.answer()
+    RECENT.add(ctx.chat_id, ctx.message.message_id, ctx.user_id, ctx.text)
 
-    data = query.data or ""
-    chat = query.message.chat if query.message else None
+    started = time.perf_counter()
+    try:
+        await moderate(update, context, ctx)
+    finally:
+        LOAD.observe(time.perf_counter() - started)
 
-    # PM menu
-    if chat and chat.type == ChatType.PRIVATE and data.startswith("pm:"):
-        if data == "pm:help":
-            return await query.edit_message_text(pm_help_text(), reply_markup=pm_keyboard())
-        if data == "pm:configinfo":
-            return await query.edit_message_text(pm_config_info_text(), reply_markup=pm_keyboard())
-        if data == "pm:perms":
-            return await query.edit_message_text(pm_perms_text(), reply_markup=pm_keyboard())
+
+async def moderate(update: Update, context: ContextTypes.DEFAULT_TYPE, ctx: MessageContext):
+    with span("stage", "is_admin"):
+        admin = await is_admin(update, context, user_id=ctx.user_id)
+    if RECORDER:
+        RECORDER.write(ctx, admin)
+
+    # no castigar admins/owner
+    if admin:
         return
 
-    # Config menus (solo grupos)
-    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+    verdict = await run_filters(ctx, context, inspection_skips(ctx.chat_id, ctx.user_id))
+    if not verdict:
+        if not ctx.is_edit:
+            TRUST.note_message(ctx.chat_id, ctx.user_id)
+            # mensaje limpio de un miembro confiable = ejemplo de ham (muestreado)
+            if ctx.text and random.random() < CLF_HAM_SAMPLE and TRUST.is_trusted(ctx.chat_id, ctx.user_id):
+                CLASSIFIER.learn(ctx.chat_id, ctx.text, spam=False)
         return
 
-    # seguridad: solo admins pueden usar los botones del menú
-    fake_update = Update(update.update_id, callback_query=query)
-    if not await is_admin(fake_update, context):
-        return await query.edit_message_text("❌ Solo administradores pueden usar este menú.")
+    stats_add(ctx.chat_id, RULE_STATS.get(verdict.rule, verdict.rule), verdict.stat_key)
+    # lo que borran las otras reglas es spam etiquetado (el clasificador no aprende de sí mismo)
+    if verdict.rule != "classifier" and verdict.action != "log" and ctx.text:
+        CLASSIFIER.learn(ctx.chat_id, ctx.text, spam=True)
+    if verdict.action == "log":
+        return await send_modlog(context, ctx.chat_id, f"👀 {verdict.modlog_label} | msg {ctx.message.message_id}")
+    if verdict.action == "delete":
+        try:
+            await ctx.message.delete()
+        except Exception:
+            pass
+        RECENT.forget(ctx.chat_id, [ctx.message.message_id])
+        await send_notice(context, ctx.chat_id, removed=1, text=f"🚫 Mensaje eliminado ({verdict.notice_detail})")
+        return await send_modlog(context, ctx.chat_id, f"🚫 {verdict.modlog_label}")
+    await punish_message(
+        update, context, ctx.chat_id, ctx.user_id,
+        reason=verdict.reason,
+        notice_detail=verdict.notice_detail,
+        modlog_label=verdict.modlog_label,
+        source=verdict.rule,
+    )
 
-    chat_id = chat.id
 
-    # cerrar
-    if data == "cfg:close":
-        context.chat_data[STATE_KEY] = STATE_NONE
-        return await query.edit_message_text("✅ Menú cerrado.")
+async def punish_message(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int,
+                         reason: str, notice_detail: str, modlog_label: str, source: str):
+    # 1) borrar mensaje
+    try:
+        await update.effective_message.delete()
+    except Exception:
+        # si no se puede borrar, seguimos con warn (pero ideal tener permiso delete)
+        pass
+    RECENT.forget(chat_id, [update.effective_message.message_id])
 
-    # volver
-    if data == "cfg:back":
-        context.chat_data[STATE_KEY] = STATE_NONE
-        return await query.edit_message_text(
-            config_header_text(chat_id),
-            reply_markup=main_config_keyboard(),
-            parse_mode="Markdown",
-        )
+    # 2) warn automático
+    add_warn(chat_id, user_id, warned_by=0, reason=reason)  # 0 = automático
 
-    # abrir sub-menus
-    if data == "cfg:menu:warn":
-        temp = context.chat_data.get(TEMP_LIMIT_KEY, get_warn_limit(chat_id))
-        return await query.edit_message_text(
-            warn_menu_text(chat_id, temp),
-            reply_markup=warn_menu_keyboard(),
-            parse_mode="Markdown",
-        )
+    total = count_warns(chat_id, user_id)
+    limit = get_warn_limit(chat_id)
 
-    if data == "cfg:menu:bw":
-        context.chat_data[STATE_KEY] = STATE_NONE
-        return await query.edit_message_text(
-            "🚫 *Banned words*\n\nElige una opción:",
-            reply_markup=bw_menu_keyboard(),
-            parse_mode="Markdown",
-        )
+    # aviso breve en el chat (agrupado por ventana; en modo degradado solo se cuenta)
+    await send_notice(
+        context, chat_id, removed=1, warned=user_id,
+        text=f"🚫 Mensaje eliminado. ⚠️ Warn {total}/{limit} para {user_id} ({notice_detail})",
+    )
 
-    if data == "cfg:menu:log":
-        is_on = bool(get_log_chat_id(chat_id))
-        return await query.edit_message_text(
-            log_menu_text(chat_id),
-            reply_markup=log_menu_keyboard(is_on),
-            parse_mode="Markdown",
-        )
+    await send_modlog(context, chat_id, f"🚫 {modlog_label} | warn {total}/{limit}")
 
-    # warn limit adjustments
-    if data.startswith("cfg:warn:"):
-        temp = int(context.chat_data.get(TEMP_LIMIT_KEY, get_warn_limit(chat_id)))
+    # 3) autoban si llega al límite (actor_id=0 = automático)
+    await maybe_autoban_after_warn(update, context, chat_id, user_id, actor_id=0, source=source)
 
-        if data == "cfg:warn:inc":
-            temp = clamp(temp + 1, MIN_WARN_LIMIT, MAX_WARN_LIMIT)
-        elif data == "cfg:warn:dec":
-            temp = clamp(temp - 1, MIN_WARN_LIMIT, MAX_WARN_LIMIT)
-        elif data.startswith("cfg:warn:set:"):
-            try:
-                v = int(data.split(":")[-1])
-                temp = clamp(v, MIN_WARN_LIMIT, MAX_WARN_LIMIT)
-            except ValueError:
-                pass
-        elif data == "cfg:warn:save":
-            set_warn_limit(chat_id, clamp(temp, MIN_WARN_LIMIT, MAX_WARN_LIMIT))
-            context.chat_data[TEMP_LIMIT_KEY] = get_warn_limit(chat_id)
-            return await query.edit_message_text(
-                config_header_text(chat_id),
-                reply_markup=main_config_keyboard(),
-                parse_mode="Markdown",
-            )
 
-        context.chat_data[TEMP_LIMIT_KEY] = temp
-        return await query.edit_message_text(
-            warn_menu_text(chat_id, temp),
-            reply_markup=warn_menu_keyboard(),
-            parse_mode="Markdown",
-        )
+# -------------------- RECORD / REPLAY --------------------
+# Grabación opcional del tráfico (RECORD_PATH) en JSONL gzip, una línea por mensaje:
+#   t=epoch c=chat u=user m=message_id e=edición a=admin x=texto | h=tokens hasheados
+#   n=nº de URLs k=[kind, file_unique_id]
+# `python bot.py replay <archivo>` lo pasa por los filtros sin llamar al Bot API.
+WORD_RE = re.compile(r"\w+")
 
-    # banned words actions
-    if data == "cfg:bw:view":
-        return await query.edit_message_text(
-            bw_view_text(chat_id),
-            reply_markup=bw_menu_keyboard(),
-            parse_mode="Markdown",
-        )
 
-    if data == "cfg:bw:add":
-        context.chat_data[STATE_KEY] = STATE_ADD_BW
-        return await query.edit_message_text(
-            "➕ Envíame la palabra a *agregar* (un solo texto).\n\nEj: `spam`\n\n(Escribe la palabra ahora en el chat)",
-            reply_markup=bw_menu_keyboard(),
-            parse_mode="Markdown",
-        )
+def hash_tokens(text: str, salt: str) -> list[str]:
+    return [
+        hashlib.blake2b(tok.encode(), digest_size=6, key=salt.encode()[:64]).hexdigest()
+        for tok in WORD_RE.findall(text)
+    ]
 
-    if data == "cfg:bw:remove":
-        context.chat_data[STATE_KEY] = STATE_REMOVE_BW
-        return await query.edit_message_text(
-            "➖ Envíame la palabra a *quitar*.\n\nEj: `spam`\n\n(Escribe la palabra ahora en el chat)",
-            reply_markup=bw_menu_keyboard(),
-            parse_mode="Markdown",
-        )
 
-    # log actions
-    if data == "cfg:log:on_here":
-        set_log_chat_id(chat_id, chat_id)
-        return await query.edit_message_text(
-            log_menu_text(chat_id),
-            reply_markup=log_menu_keyboard(True),
-            parse_mode="Markdown",
-        )
+def trim_recording(path: str) -> int:
+    """
+    Corta un final truncado (miembro gzip sin cerrar tras un kill) para poder seguir añadiendo.
+    Devuelve los bytes descartados.
+    """
+    if not os.path.exists(path):
+        return 0
+    good = pos = 0
+    d = zlib.decompressobj(31)
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                while chunk:
+                    d.decompress(chunk)
+                    if not d.eof:
+                        pos += len(chunk)
+                        break
+                    pos += len(chunk) - len(d.unused_data)
+                    good = pos
+                    chunk, d = d.unused_data, zlib.decompressobj(31)
+    except zlib.error:
+        pass
+    size = os.path.getsize(path)
+    if good < size:
+        os.truncate(path, good)
+    return size - good
+
+
+class TrafficRecorder:
+    """El archivo se abre en la primera escritura y flush() cierra el miembro gzip en curso."""
+
+    def __init__(self, path: str, hash_text: bool, salt: str):
+        self.path = path
+        self.hash_text = hash_text
+        self.salt = salt
+        self._f = None
+        dropped = trim_recording(path)
+        if dropped:
+            print(f"⚠️ Grabación {path}: se descartaron {dropped} bytes de un final truncado")
+
+    def write(self, ctx: MessageContext, is_admin_user: bool):
+        rec = {"t": round(time.time(), 3), "c": ctx.chat_id, "u": ctx.user_id, "m": ctx.message.message_id}
+        if ctx.is_edit:
+            rec["e"] = 1
+        if is_admin_user:
+            rec["a"] = 1
+        if ctx.raw_text:
+            if self.hash_text:
+                rec["h"] = hash_tokens(ctx.text, self.salt)
+            else:
+                rec["x"] = ctx.raw_text
+        if ctx.urls:
+            rec["n"] = len(ctx.urls)
+        if ctx.media:
+            rec["k"] = [ctx.media[0], ctx.media[1]]
+        if self._f is None:
+            self._f = gzip.open(self.path, "at", encoding="utf-8")
+        self._f.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def flush(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    close = flush
+
+
+RECORDER: Optional[TrafficRecorder] = None  # solo lo abre el bot (post_init), nunca replay/evalclf
+
+
+async def record_flush_loop():
+    while True:
+        await asyncio.sleep(RECORD_FLUSH_SECONDS)
+        try:
+            if RECORDER:
+                RECORDER.flush()
+        except Exception as e:
+            print(f"⚠️ Error guardando grabación: {e}")
+
+
+class ReplayContext(MessageContext):
+    """Contexto reconstruido desde una grabación (sin objeto Message)."""
+    __slots__ = ("hashes",)
+
+
+def replay_context(rec: dict) -> ReplayContext:
+    k = rec.get("k")
+    ctx = ReplayContext(None, rec["c"], rec["u"], bool(rec.get("e")), rec.get("x", ""), [""] * rec.get("n", 0),
+                        (k[0], k[1], None) if k else None)
+    ctx.hashes = rec.get("h")
+    return ctx
+
+
+def hashed_bw_checker(words_by_chat: dict[int, list[str]], salt: str):
+    """Banned words contra textos hasheados: coincide la secuencia de tokens (palabra completa)."""
+    cache: dict[int, list[tuple[str, list[str]]]] = {}
+
+    async def check(ctx: ReplayContext, context) -> Optional[Verdict]:
+        if ctx.hashes is None:
+            return await check_banned_words(ctx, context)
+        if ctx.chat_id not in cache:
+            words = words_by_chat.get(ctx.chat_id)
+            if words is None:
+                words = bw_list(ctx.chat_id)
+            cache[ctx.chat_id] = [(w, hash_tokens(w, salt)) for w in words if WORD_RE.search(w)]
+        hashes = ctx.hashes
+        for word, seq in cache[ctx.chat_id]:
+            n = len(seq)
+            if any(hashes[i:i + n] == seq for i in range(len(hashes) - n + 1)):
+                return Verdict("banned_word", f"banned word: {word}", word, word, stat_key=word)
+        return None
+
+    return check
+
+
+def read_recording(path: str, status: dict):
+    """Registros de una grabación; si el último miembro gzip quedó truncado para ahí (status["truncated"])."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    status["truncated"] = True
+                    return
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            status["truncated"] = True
+
+
+async def replay(path: str, words: Optional[list[str]], warn_limit: Optional[int], chat: Optional[int]) -> dict:
+    """Pasa una grabación por los filtros en modo dry-run y devuelve el reporte."""
+    if words is not None:
+        pattern = re.compile("|".join(map(re.escape, sorted(words, key=len, reverse=True)))) if words else None
+    words_by_chat: dict[int, list[str]] = {}
+    filters_ = [
+        (name, hashed_bw_checker(words_by_chat, RECORD_SALT) if name == "banned_words" else check)
+        for name, check in MESSAGE_FILTERS
+    ]
+    context = SimpleNamespace(bot=None, bot_data={}, chat_data={})
+
+    hits: Counter[str] = Counter()
+    keys: Counter[tuple[str, str]] = Counter()
+    actions: Counter[str] = Counter()
+    warns: Counter[tuple[int, int]] = Counter()
+    banned: set[tuple[int, int]] = set()
+    latencies: list[float] = []
+    total = skipped = 0
+
+    status = {"truncated": False}
+    started = time.perf_counter()
+    for rec in read_recording(path, status):
+        if chat is not None and rec["c"] != chat:
+            continue
+        total += 1
+        who = (rec["c"], rec["u"])
+        if rec.get("a") or who in banned:
+            skipped += 1
+            continue
+        if words is not None and rec["c"] not in words_by_chat:
+            words_by_chat[rec["c"]] = words
+            BW_MATCHERS[rec["c"]] = pattern
+
+        ctx = replay_context(rec)
+        t0 = time.perf_counter()
+        verdict = None
+        for _, check in filters_:
+            verdict = await check(ctx, context)
+            if verdict:
+                break
+        latencies.append(time.perf_counter() - t0)
+        if not verdict:
+            continue
+
+        hits[verdict.rule] += 1
+        keys[(verdict.rule, verdict.stat_key)] += 1
+        if verdict.action == "log":
+            actions["log"] += 1
+            continue
+        actions["delete"] += 1
+        if verdict.action == "delete":
+            continue
+        actions["warn"] += 1
+        warns[who] += 1
+        if warns[who] >= (warn_limit or get_warn_limit(rec["c"])):
+            actions["ban"] += 1
+            banned.add(who)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def pct(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e6 if latencies else 0.0
+
+    return {
+        "messages": total,
+        "skipped": skipped,
+        "truncated": status["truncated"],
+        "hits": dict(hits),
+        "top_keys": keys.most_common(15),
+        "actions": dict(actions),
+        "elapsed_s": elapsed,
+        "throughput_msg_s": total / elapsed if elapsed else 0.0,
+        "latency_us": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "max": pct(1.0)},
+    }
+
+
+def replay_main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bot.py replay", description="Dry-run de una grabación contra los filtros.")
+    parser.add_argument("path")
+    parser.add_argument("--words", help="banned words separadas por coma (reemplaza las de la DB)")
+    parser.add_argument("--warn-limit", type=int, help="límite de warns a simular")
+    parser.add_argument("--chat", type=int, help="solo este chat")
+    args = parser.parse_args(argv)
+
+    words = [w for w in (normalize_word(w) for w in args.words.split(",")) if w] if args.words is not None else None
+    init_db()
+    report = asyncio.run(replay(args.path, words, args.warn_limit, args.chat))
+
+    print(f"📼 {report['messages']} mensajes ({report['skipped']} omitidos: admins / ya baneados)")
+    if report["truncated"]:
+        print("⚠️ La grabación termina truncada (bot cortado sin cerrar): se procesó hasta ahí.")
+    print(f"⏱️ {report['elapsed_s']:.2f}s → {report['throughput_msg_s']:.0f} msg/s")
+    lat = report["latency_us"]
+    print(f"   latencia filtros µs: p50 {lat['p50']:.0f} | p95 {lat['p95']:.0f} | p99 {lat['p99']:.0f} | max {lat['max']:.0f}")
+    print("🎯 Hits por regla:")
+    for rule, n in sorted(report["hits"].items(), key=lambda kv: -kv[1]):
+        print(f"   {rule}: {n}")
+    for (rule, key), n in report["top_keys"]:
+        print(f"   – {rule} '{key}': {n}")
+    print("🛠️ Acciones (simuladas):")
+    for action, n in report["actions"].items():
+        print(f"   {action}: {n}")
+
+
+def evaluate_classifier(examples: list[tuple[list[int], bool]], split: float) -> dict:
+    """Entrena con el primer `split` (orden cronológico) y mide sobre el resto."""
+    cut = int(len(examples) * split)
+    model = NaiveBayes()
+    for feats, spam in examples[:cut]:
+        model.learn(feats, spam)
+    test = examples[cut:]
+    started = time.perf_counter()
+    scored = [(model.spam_probability(feats), spam) for feats, spam in test]
+    elapsed = time.perf_counter() - started
+
+    thresholds = {}
+    for t in (0.5, 0.8, 0.9, 0.95, 0.99):
+        tp = sum(1 for p, spam in scored if p >= t and spam)
+        fp = sum(1 for p, spam in scored if p >= t and not spam)
+        fn = sum(1 for p, spam in scored if p < t and spam)
+        ham = sum(1 for _, spam in scored if not spam)
+        thresholds[t] = {
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 0.0,
+            "fpr": fp / ham if ham else 0.0,
+        }
+    return {
+        "train": (model.docs[1], model.docs[0]),
+        "test": (sum(1 for _, s in test if s), sum(1 for _, s in test if not s)),
+        "thresholds": thresholds,
+        "score_us": elapsed / len(test) * 1e6 if test else 0.0,
+    }
+
+
+def evalclf_main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="bot.py evalclf", description="Evaluación offline del clasificador de spam.")
+    parser.add_argument("--model", type=int, help=f"model_id (chat_id, o {CLF_SHARED_MODEL} = compartido); por defecto todos")
+    parser.add_argument("--file", help='JSONL con {"text": ..., "spam": true|false} en vez de los ejemplos de la DB')
+    parser.add_argument("--split", type=float, default=0.8, help="fracción (cronológica) para entrenar")
+    args = parser.parse_args(argv)
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        examples = [(clf_features(r["text"].lower()), bool(r["spam"])) for r in rows]
+    else:
+        init_db()
+        examples = []
+        for row in load_classifier_examples(args.model):
+            feats = array("I")
+            feats.frombytes(row["features"])
+            examples.append((feats.tolist(), bool(row["spam"])))
+    examples = [(feats, spam) for feats, spam in examples if feats]
+    if len(examples) < 10:
+        return print("🧠 Muy pocos ejemplos para evaluar.")
+
+    report = evaluate_classifier(examples, clamp(args.split, 0.1, 0.95))
+    print(f"🧠 Entrenamiento: {report['train'][0]} spam / {report['train'][1]} ham")
+    print(f"   Prueba: {report['test'][0]} spam / {report['test'][1]} ham · {report['score_us']:.0f} µs por mensaje")
+    for t, m in report["thresholds"].items():
+        print(f"   ≥ {t:.2f}: precisión {m['precision']:.1%} | recall {m['recall']:.1%} | falsos positivos {m['fpr']:.2%}")
+
+
+# -------------------- CALLBACKS (MENÚ COMPLETO + PM) --------------------
+# Cada botón del menú se resuelve en una tabla: callback_data -> handler(query, context, chat_id, data).
+def last_render_key(query) -> tuple[int, int]:
+    return (query.message.chat.id, query.message.message_id)
+
+
+async def edit_menu(query, text: str, markup: Optional[InlineKeyboardMarkup] = None, parse_mode: Optional[str] = "Markdown"):
+    """Edita el menú solo si el texto/teclado cambió (evita 'message is not modified')."""
+    key = last_render_key(query)
+    if MENU_LAST_RENDER.get(key) == (text, markup):
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    remember_render(key, text, markup)
+
+
+def remember_render(key: tuple[int, int], text: str, markup: Optional[InlineKeyboardMarkup]):
+    MENU_LAST_RENDER[key] = (text, markup)
+    MENU_LAST_RENDER.move_to_end(key)
+    while len(MENU_LAST_RENDER) > MENU_RENDER_CACHE_SIZE:
+        MENU_LAST_RENDER.popitem(last=False)
+
+
+def schedule_menu_edit(query, render):
+    """
+    Agrupa ráfagas de taps: la primera programa un edit tras MENU_DEBOUNCE_SECONDS y las
+    siguientes solo actualizan el estado; `render()` se evalúa al disparar (estado final).
+    """
+    key = last_render_key(query)
+    if key in MENU_PENDING_EDITS:
+        return
+
+    async def fire():
+        try:
+            await asyncio.sleep(MENU_DEBOUNCE_SECONDS)
+            text, markup = render()
+            await edit_menu(query, text, markup)
+        except Exception:
+            pass
+        finally:
+            if MENU_PENDING_EDITS.get(key) is asyncio.current_task():
+                MENU_PENDING_EDITS.pop(key, None)
+
+    MENU_PENDING_EDITS[key] = asyncio.create_task(fire())
+
+
+def cancel_menu_edit(query):
+    """Descarta un edit agrupado pendiente (p.ej. el admin pulsa Guardar/Volver dentro de la ventana)."""
+    task = MENU_PENDING_EDITS.pop(last_render_key(query), None)
+    if task:
+        task.cancel()
 
-    if data == "cfg:log:off":
-        set_log_chat_id(chat_id, None)
-        return await query.edit_message_text(
-            log_menu_text(chat_id),
-            reply_markup=log_menu_keyboard(False),
-            parse_mode="Markdown",
-        )
 
-    if data == "cfg:log:test":
-        await send_modlog(context, chat_id, f"✅ LOGTEST OK | grupo {chat_id}")
-        return await query.edit_message_text(
-            log_menu_text(chat_id) + "\n\n✅ Envié un mensaje de prueba al log.",
-            reply_markup=log_menu_keyboard(bool(get_log_chat_id(chat_id))),
-            parse_mode="Markdown",
+def main_menu_render(chat_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    return config_header_text(get_chat_settings(chat_id)), main_config_keyboard()
+
+
+def warn_menu_render(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> tuple[str, InlineKeyboardMarkup]:
+    settings = get_chat_settings(chat_id)
+    temp = int(context.chat_data.get(TEMP_LIMIT_KEY, settings["warn_limit"]))
+    return warn_menu_text(settings, temp), warn_menu_keyboard()
+
+
+def log_menu_render(chat_id: int, suffix: str = "") -> tuple[str, InlineKeyboardMarkup]:
+    log_id = get_chat_settings(chat_id)["log_chat_id"]
+    return log_menu_text(log_id) + suffix, log_menu_keyboard(bool(log_id))
+
+
+async def cfg_close(query, context, chat_id: int, data: str):
+    context.chat_data[STATE_KEY] = STATE_NONE
+    await edit_menu(query, "✅ Menú cerrado.", parse_mode=None)
+
+
+async def cfg_back(query, context, chat_id: int, data: str):
+    context.chat_data[STATE_KEY] = STATE_NONE
+    await edit_menu(query, *main_menu_render(chat_id))
+
+
+async def cfg_menu_warn(query, context, chat_id: int, data: str):
+    await edit_menu(query, *warn_menu_render(chat_id, context))
+
+
+async def cfg_menu_bw(query, context, chat_id: int, data: str):
+    context.chat_data[STATE_KEY] = STATE_NONE
+    await edit_menu(query, "🚫 *Banned words*\n\nElige una opción:", bw_menu_keyboard())
+
+
+async def cfg_menu_log(query, context, chat_id: int, data: str):
+    await edit_menu(query, *log_menu_render(chat_id))
+
+
+async def cfg_warn_adjust(query, context, chat_id: int, data: str):
+    # inc/dec/set: el estado cambia al instante, el edit se agrupa (debounce)
+    temp = int(context.chat_data.get(TEMP_LIMIT_KEY, get_warn_limit(chat_id)))
+    if data == "cfg:warn:inc":
+        temp += 1
+    elif data == "cfg:warn:dec":
+        temp -= 1
+    else:
+        try:
+            temp = int(data.split(":")[-1])
+        except ValueError:
+            pass
+    context.chat_data[TEMP_LIMIT_KEY] = clamp(temp, MIN_WARN_LIMIT, MAX_WARN_LIMIT)
+    schedule_menu_edit(query, lambda: warn_menu_render(chat_id, context))
+
+
+async def cfg_warn_save(query, context, chat_id: int, data: str):
+    temp = int(context.chat_data.get(TEMP_LIMIT_KEY, get_warn_limit(chat_id)))
+    set_warn_limit(chat_id, clamp(temp, MIN_WARN_LIMIT, MAX_WARN_LIMIT))
+    settings = get_chat_settings(chat_id)
+    context.chat_data[TEMP_LIMIT_KEY] = settings["warn_limit"]
+    await edit_menu(query, config_header_text(settings), main_config_keyboard())
+
+
+async def cfg_bw_view(query, context, chat_id: int, data: str):
+    await edit_menu(query, bw_view_text(chat_id), bw_menu_keyboard())
+
+
+async def cfg_bw_add(query, context, chat_id: int, data: str):
+    context.chat_data[STATE_KEY] = STATE_ADD_BW
+    await edit_menu(
+        query,
+        "➕ Envíame la palabra a *agregar* (un solo texto).\n\nEj: `spam`\n\n(Escribe la palabra ahora en el chat)",
+        bw_menu_keyboard(),
+    )
+
+
+async def cfg_bw_remove(query, context, chat_id: int, data: str):
+    context.chat_data[STATE_KEY] = STATE_REMOVE_BW
+    await edit_menu(
+        query,
+        "➖ Envíame la palabra a *quitar*.\n\nEj: `spam`\n\n(Escribe la palabra ahora en el chat)",
+        bw_menu_keyboard(),
+    )
+
+
+async def cfg_bw_retro(query, context, chat_id: int, data: str):
+    deleted, users = await retro_scan(context, chat_id)
+    await edit_menu(
+        query,
+        f"🔎 Revisión de los últimos {RETRO_SCAN_MINUTES} min: {deleted} mensajes borrados ({users} usuarios).",
+        parse_mode=None,
+    )
+    if deleted:
+        await send_modlog(
+            context, chat_id,
+            f"🔎 BANNED WORD RETRO | admin {query.from_user.id} | {deleted} msgs de {users} usuarios",
         )
 
 
+async def cfg_log_on_here(query, context, chat_id: int, data: str):
+    set_log_chat_id(chat_id, chat_id)
+    await edit_menu(query, *log_menu_render(chat_id))
+
+
+async def cfg_log_off(query, context, chat_id: int, data: str):
+    set_log_chat_id(chat_id, None)
+    await edit_menu(query, *log_menu_render(chat_id))
+
+
+async def cfg_log_test(query, context, chat_id: int, data: str):
+    await send_modlog(context, chat_id, f"✅ LOGTEST OK | grupo {chat_id}")
+    await edit_menu(query, *log_menu_render(chat_id, "\n\n✅ Envié un mensaje de prueba al log."))
+
+
+async def warns_page_callback(query, context, chat_id: int, data: str):
+    _, uid, before = data.split(":")
+    text, markup = warns_page(chat_id, int(uid), int(before) or None)
+    await edit_menu(query, text, markup, parse_mode=None)
+
+
+async def history_callback(query, context, data: str):
+    # mismo alcance que /history: el grupo del mensaje, o en privado los grupos donde el que pulsa es admin
+    _, uid, raw = data.split(":", 2)
+    cursor = None
+    if raw != "0":
+        us, kind, last_id = raw.split(".")
+        cursor = (us_to_iso(int(us)), int(kind), int(last_id))
+    chat_ids = await history_chats(context, query.message.chat if query.message else None, query.from_user.id, int(uid))
+    if not chat_ids:
+        return await edit_menu(query, "❌ Solo administradores.", parse_mode=None)
+    text, markup = history_page(int(uid), chat_ids, cursor)
+    await edit_menu(query, text, markup, parse_mode=None)
+
+
+PM_ROUTES = {
+    "pm:help": pm_help_text,
+    "pm:configinfo": pm_config_info_text,
+    "pm:perms": pm_perms_text,
+}
+
+CFG_ROUTES = {
+    "cfg:close": cfg_close,
+    "cfg:back": cfg_back,
+    "cfg:menu:warn": cfg_menu_warn,
+    "cfg:menu:bw": cfg_menu_bw,
+    "cfg:menu:log": cfg_menu_log,
+    "cfg:warn:inc": cfg_warn_adjust,
+    "cfg:warn:dec": cfg_warn_adjust,
+    "cfg:warn:save": cfg_warn_save,
+    "cfg:bw:view": cfg_bw_view,
+    "cfg:bw:add": cfg_bw_add,
+    "cfg:bw:remove": cfg_bw_remove,
+    "cfg:bw:retro": cfg_bw_retro,
+    "cfg:log:on_here": cfg_log_on_here,
+    "cfg:log:off": cfg_log_off,
+    "cfg:log:test": cfg_log_test,
+}
+
+# rutas con argumentos en el callback_data
+CFG_PREFIX_ROUTES = (
+    ("cfg:warn:set:", cfg_warn_adjust),
+    ("warns:", warns_page_callback),
+)
+
+
+def route_for(data: str):
+    handler = CFG_ROUTES.get(data)
+    if handler:
+        return handler
+    for prefix, handler in CFG_PREFIX_ROUTES:
+        if data.startswith(prefix):
+            return handler
+    return None
+
+
+async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query:
+        return
+    await query.answer()
+
+    data = query.data or ""
+    chat = query.message.chat if query.message else None
+
+    # PM menu
+    if chat and chat.type == ChatType.PRIVATE and data.startswith("pm:"):
+        render = PM_ROUTES.get(data)
+        if render:
+            await edit_menu(query, render(), pm_keyboard(context.bot.username), parse_mode=None)
+        return
+
+    if data.startswith("hist:"):
+        return await history_callback(query, context, data)
+
+    # Config menus (solo grupos)
+    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+        return
+
+    handler = route_for(data)
+    if not handler:
+        return
+
+    # seguridad: solo admins pueden usar los botones del menú (cacheado, ver is_chat_admin)
+    if not await is_chat_admin(context.bot, chat.id, query.from_user.id):
+        return await edit_menu(query, "❌ Solo administradores pueden usar este menú.", parse_mode=None)
+
+    if handler is not cfg_warn_adjust:
+        cancel_menu_edit(query)
+    await handler(query, context, chat.id, data)
+
+
 # -------------------- STATE INPUT HANDLER (ADD/REMOVE WORDS) --------------------
 async def handle_state_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cuando el admin pulsa botones para add/remove, aquí leemos la palabra que escribe."""
@@ -1015,7 +4245,7 @@ async def handle_state_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ok = bw_add(chat_id, word, admin_id)
         context.chat_data[STATE_KEY] = STATE_NONE
         if ok:
-            await update.effective_message.reply_text(f"✅ Agregada: {word}")
+            await update.effective_message.reply_text(f"✅ Agregada: {word}", reply_markup=retro_scan_keyboard())
             await send_modlog(context, chat_id, f"➕ BANNED WORD ADD | admin {admin_id} | '{word}'")
         else:
             await update.effective_message.reply_text("⚠️ Esa palabra ya estaba en la lista (o inválida).")
@@ -1032,11 +4262,426 @@ async def handle_state_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
 
+# -------------------- CARGA (MODO DEGRADADO) --------------------
+# Métricas del proceso (gauges y contadores), visibles con /metrics.
+METRICS: Counter[str] = Counter()
+
+
+class LoadMonitor:
+    """
+    Entra en modo degradado cuando el backlog de updates o la latencia de los handlers pasan
+    los umbrales altos, y sale solo tras LOAD_RECOVERY_SECONDS por debajo de los bajos
+    (histéresis). En modo degradado: se borra/banea igual, pero los avisos al chat se
+    suprimen, el mod-log se resume por grupo y las escrituras de /stats se acumulan en memoria.
+    """
+
+    def __init__(self):
+        self.apps: list[Application] = []
+        self.degraded = False
+        self.latency = 0.0  # EWMA en segundos
+        self._samples = 0   # observaciones desde el último evaluate()
+        self._calm_since: Optional[float] = None
+        self.suppressed: Counter[int] = Counter()  # chat_id -> avisos/logs no enviados
+        self.deferred_stats: Counter[tuple[int, str, str]] = Counter()
+
+    def register(self, app: Application):
+        self.apps.append(app)
+
+    def observe(self, seconds: float):
+        self.latency = LOAD_EWMA_ALPHA * seconds + (1 - LOAD_EWMA_ALPHA) * self.latency
+        self._samples += 1
+
+    def backlog(self) -> int:
+        return sum(app.update_queue.qsize() for app in self.apps)
+
+    def suppress(self, chat_id: int):
+        self.suppressed[chat_id] += 1
+        METRICS["notices_suppressed_total"] += 1
+
+    def defer_stat(self, chat_id: int, metric: str, key: str, n: int):
+        self.deferred_stats[(chat_id, metric, key)] += n
+
+    def flush_stats(self):
+        if not self.deferred_stats:
+            return
+        pending, self.deferred_stats = self.deferred_stats, Counter()
+        conn = db()
+        cur = conn.cursor()
+        for (chat_id, metric, key), n in pending.items():
+            stats_bump(cur, chat_id, metric, key, n)
+        conn.commit()
+        conn.close()
+
+    async def evaluate(self):
+        if not self._samples:
+            # sin tráfico la EWMA no se movería nunca: cada tick vacío cuenta como una muestra de 0 s
+            self.latency *= 1 - LOAD_EWMA_ALPHA
+        self._samples = 0
+        backlog = self.backlog()
+        METRICS["update_backlog"] = backlog
+        METRICS["handler_latency_ms"] = round(self.latency * 1000, 1)
+
+        if not self.degraded:
+            if backlog >= LOAD_BACKLOG_HIGH or self.latency >= LOAD_LATENCY_HIGH:
+                await self._set_degraded(True, backlog)
+            return
+
+        if backlog <= LOAD_BACKLOG_LOW and self.latency <= LOAD_LATENCY_LOW:
+            now = time.monotonic()
+            self._calm_since = self._calm_since or now
+            if now - self._calm_since >= LOAD_RECOVERY_SECONDS:
+                await self._set_degraded(False, backlog)
+        else:
+            self._calm_since = None
+
+    async def _set_degraded(self, on: bool, backlog: int):
+        self.degraded = on
+        self._calm_since = None
+        METRICS["degraded_mode"] = int(on)
+        METRICS["degraded_transitions_total"] += 1
+        if on:
+            text = f"🐢 MODO DEGRADADO ON | backlog {backlog} | latencia {self.latency * 1000:.0f} ms\nSe priorizan borrados y bans; avisos y logs se resumen."
+        else:
+            self.flush_stats()
+            text = f"✅ MODO DEGRADADO OFF | backlog {backlog} | latencia {self.latency * 1000:.0f} ms"
+        print(text)
+        if not self.apps:
+            return
+
+        bot = self.apps[0].bot
+        for chat_id in load_alert_chats():
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+            except Exception:
+                continue
+        if not on:
+            # resumen por grupo de lo que no se notificó
+            suppressed, self.suppressed = self.suppressed, Counter()
+            for chat_id, n in suppressed.items():
+                await send_modlog_bot(bot, chat_id, f"🧾 Modo degradado: {n} avisos/logs resumidos en este grupo.")
+
+
+LOAD = LoadMonitor()
+
+
+def load_alert_chats() -> list[int]:
+    if LOAD_ALERT_CHAT_ID:
+        return [int(LOAD_ALERT_CHAT_ID)]
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT log_chat_id FROM chats WHERE log_chat_id IS NOT NULL")
+    chats = [int(r["log_chat_id"]) for r in cur.fetchall()]
+    conn.close()
+    return chats
+
+
+async def load_monitor_loop():
+    last_flush = time.monotonic()
+    while True:
+        await asyncio.sleep(LOAD_CHECK_SECONDS)
+        try:
+            await LOAD.evaluate()
+            if not LOAD.degraded or time.monotonic() - last_flush >= LOAD_FLUSH_SECONDS:
+                LOAD.flush_stats()
+                last_flush = time.monotonic()
+        except Exception as e:
+            print(f"⚠️ Error en monitor de carga: {e}")
+
+
+# -------------------- PROFILING (UPDATES LENTOS) --------------------
+class UpdateProfile:
+    """Spans de un update: (tipo, nombre) -> [veces, segundos]. Pueden solaparse (un filtro incluye su API)."""
+    __slots__ = ("handler", "chat_id", "update_id", "spans")
+
+    def __init__(self, handler: str, update):
+        self.handler = handler
+        chat = getattr(update, "effective_chat", None)
+        self.chat_id = chat.id if chat else None
+        self.update_id = getattr(update, "update_id", None)
+        self.spans: dict[tuple[str, str], list] = {}
+
+    def add(self, key: tuple[str, str], seconds: float):
+        entry = self.spans.get(key)
+        if entry is None:
+            self.spans[key] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+CURRENT_PROFILE: ContextVar[Optional[UpdateProfile]] = ContextVar("current_profile", default=None)
+
+
+class Span:
+    __slots__ = ("profile", "key", "start")
+
+    def __init__(self, profile: UpdateProfile, key: tuple[str, str]):
+        self.profile = profile
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add(self.key, time.perf_counter() - self.start)
+        return False
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def span(kind: str, name: str):
+    """Mide un tramo del update en curso; sin profiling activo no cuesta casi nada."""
+    profile = CURRENT_PROFILE.get()
+    return Span(profile, (kind, name)) if profile is not None else NO_SPAN
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Conexión que reporta como span "db" el tiempo entre abrirla y cerrarla (un helper completo)."""
+
+    def close(self):
+        super().close()
+        self.profile.add(("db", self.helper), time.perf_counter() - self.opened)
+
+
+def profiled_connect(path: str, helper: str, uri: bool = False) -> sqlite3.Connection:
+    opened = time.perf_counter()
+    conn = sqlite3.connect(path, uri=uri, factory=ProfiledConnection)
+    conn.row_factory = sqlite3.Row
+    conn.profile, conn.helper, conn.opened = CURRENT_PROFILE.get(), helper, opened
+    return conn
+
+
+class SlowUpdateProfiler:
+    """
+    Envuelve los handlers: cada update se cronometra y, si pasa PROFILE_SLOW_MS (o cae en la
+    muestra), se guarda un reporte JSON con sus spans en PROFILE_DIR (anillo de
+    PROFILE_MAX_REPORTS archivos). cProfile solo se activa en updates muestreados, uno a la vez.
+    """
+
+    def __init__(self, slow_ms: int, sample_rate: float, use_cprofile: bool, directory: str = PROFILE_DIR):
+        self.slow = slow_ms / 1000
+        self.sample_rate = sample_rate
+        self.use_cprofile = use_cprofile
+        self.directory = directory
+        self._cprofile_busy = False
+        self._seq = 0
+
+    def wrap(self, callback):
+        name = getattr(callback, "__name__", repr(callback))
+
+        async def profiled(update, context):
+            profile = UpdateProfile(name, update)
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+            cprof = None
+            if sampled and self.use_cprofile and not self._cprofile_busy:
+                self._cprofile_busy = True
+                cprof = cProfile.Profile()
+                cprof.enable()
+            token = CURRENT_PROFILE.set(profile)
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                elapsed = time.perf_counter() - started
+                CURRENT_PROFILE.reset(token)
+                if cprof:
+                    cprof.disable()
+                    self._cprofile_busy = False
+                if elapsed >= self.slow or sampled:
+                    METRICS["slow_updates_total" if elapsed >= self.slow else "sampled_updates_total"] += 1
+                    try:
+                        self.write_report(profile, elapsed, sampled, cprof)
+                    except OSError as e:
+                        print(f"⚠️ No se pudo guardar el perfil: {e}")
+
+        profiled.__name__ = name
+        return profiled
+
+    def write_report(self, profile: UpdateProfile, elapsed: float, sampled: bool, cprof: Optional[cProfile.Profile]):
+        report = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "handler": profile.handler,
+            "chat_id": profile.chat_id,
+            "update_id": profile.update_id,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "slow": elapsed >= self.slow,
+            "sampled": sampled,
+            "spans": [
+                {"kind": kind, "name": name, "count": count, "ms": round(seconds * 1000, 2)}
+                for (kind, name), (count, seconds) in sorted(profile.spans.items(), key=lambda kv: -kv[1][1])
+            ],
+        }
+        if cprof:
+            out = io.StringIO()
+            pstats.Stats(cprof, stream=out).sort_stats("cumulative").print_stats(PROFILE_STACK_LINES)
+            report["stack"] = out.getvalue().splitlines()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._seq += 1
+        path = os.path.join(self.directory, f"{time.time_ns()}-{self._seq}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False)
+        for old in self.report_files()[PROFILE_MAX_REPORTS:]:
+            os.remove(old)
+
+    def report_files(self) -> list[str]:
+        """Más nuevos primero (el nombre empieza con el timestamp en ns)."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((n for n in os.listdir(self.directory) if n.endswith(".json")), reverse=True)
+        return [os.path.join(self.directory, n) for n in names]
+
+    def load_reports(self) -> list[dict]:
+        reports = []
+        for path in self.report_files():
+            try:
+                with open(path, encoding="utf-8") as f:
+                    reports.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return reports
+
+
+PROFILER: Optional[SlowUpdateProfiler] = (
+    SlowUpdateProfiler(PROFILE_SLOW_MS, PROFILE_SAMPLE_RATE, PROFILE_CPROFILE) if PROFILE_SLOW_MS else None
+)
+
+
+def slow_paths(reports: list[dict]) -> list[tuple[str, int, float, float]]:
+    """Agrupa reportes lentos por handler + span dominante: (camino, veces, ms promedio, ms máx)."""
+    groups: dict[str, list[float]] = {}
+    for r in reports:
+        if not r.get("slow"):
+            continue
+        top = r["spans"][0] if r["spans"] else None
+        path = r["handler"] + (f" → {top['kind']}:{top['name']}" if top else "")
+        groups.setdefault(path, []).append(r["elapsed_ms"])
+    rows = [(path, len(ms), sum(ms) / len(ms), max(ms)) for path, ms in groups.items()]
+    rows.sort(key=lambda row: -row[1] * row[2])
+    return rows
+
+
+# -------------------- RATE LIMIT (POR BOT) --------------------
+class BotRateLimiter(BaseRateLimiter):
+    """
+    Un limitador por Application: cuenta llamadas por endpoint, limita a API_GLOBAL_RATE
+    req/s y respeta RetryAfter. Así varios bots en un proceso no se pisan los límites.
+    """
+
+    def __init__(self):
+        self.calls: Counter[str] = Counter()
+        self.throttled = 0
+        self._window: deque[float] = deque()
+        self._retry_until = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _wait_slot(self):
+        while True:
+            now = time.monotonic()
+            if self._retry_until > now:
+                await asyncio.sleep(self._retry_until - now)
+                continue
+            while self._window and self._window[0] <= now - 1:
+                self._window.popleft()
+            if len(self._window) < API_GLOBAL_RATE:
+                self._window.append(now)
+                return
+            self.throttled += 1
+            await asyncio.sleep(self._window[0] + 1 - now)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.calls[endpoint] += 1
+        with span("api", endpoint):
+            await self._wait_slot()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self.throttled += 1
+                self._retry_until = time.monotonic() + wait
+                await self._wait_slot()
+                return await callback(*args, **kwargs)
+
+
 # -------------------- MAIN --------------------
-def main():
-    init_db()
+# id(app) -> tareas de ese bot; None = tareas del proceso (viven hasta que se apaga el último bot)
+BACKGROUND_TASKS: dict[Optional[int], set[asyncio.Task]] = {}
+
+
+def spawn(app: Optional[Application], coro, name: Optional[str] = None) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    BACKGROUND_TASKS.setdefault(id(app) if app is not None else None, set()).add(task)
+    return task
+
+
+def open_recorder():
+    global RECORDER
+    if RECORD_PATH and RECORDER is None:
+        RECORDER = TrafficRecorder(RECORD_PATH, RECORD_HASH_TEXT, RECORD_SALT)
+        spawn(None, record_flush_loop(), name="record")
+
+
+async def post_init(app: Application):
+    # tareas del proceso (una sola vez aunque haya varios bots)
+    if None not in BACKGROUND_TASKS:
+        spawn(None, archive_loop(), name="archive")
+        spawn(None, load_monitor_loop(), name="load")
+        spawn(None, trust_flush_loop(), name="trust")
+        spawn(None, classifier_flush_loop(), name="classifier")
+        spawn(None, user_index_flush_loop(), name="users")
+        open_recorder()
+    LOAD.register(app)
+    notices = app.bot_data[NOTICES_KEY] = NoticeAggregator(app.bot)
+    spawn(app, notices.run())
+    await start_scheduler(app)
+
+
+async def post_shutdown(app: Application):
+    for task in BACKGROUND_TASKS.pop(id(app), ()):
+        task.cancel()
+    SCHEDULERS.pop(app.bot.id, None)
+    if app in LOAD.apps:
+        LOAD.apps.remove(app)
+    if any(key is not None for key in BACKGROUND_TASKS):
+        return  # quedan otros bots: las tareas y caches del proceso siguen
+    for task in BACKGROUND_TASKS.pop(None, ()):
+        task.cancel()
+    TRUST.flush()
+    CLASSIFIER.flush()
+    USERS.flush()
+    if RECORDER:
+        RECORDER.close()
+
+
+def build_application(token: str) -> Application:
+    app = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(BotRateLimiter())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    app = Application.builder().token(TOKEN).build()
+    # índice de usuarios: ve todos los updates antes que el resto
+    app.add_handler(TypeHandler(Update, track_users), group=-1)
 
     # base
     app.add_handler(CommandHandler("start", start))
@@ -1053,16 +4698,91 @@ def main():
     app.add_handler(CommandHandler("mute", mute_cmd))
     app.add_handler(CommandHandler("ban", ban_cmd))
     app.add_handler(CommandHandler("unban", unban_cmd))
+    app.add_handler(CommandHandler("tban", tban_cmd))
+    app.add_handler(CommandHandler("unmute", unmute_cmd))
+    app.add_handler(CommandHandler("sanctions", sanctions_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
+    app.add_handler(CommandHandler("noticettl", noticettl_cmd))
+    app.add_handler(CommandHandler("trust", trust_cmd))
+    app.add_handler(CommandHandler("slow", slow_cmd))
+    app.add_handler(CommandHandler("purge", purge_cmd))
+    app.add_handler(CommandHandler("heuristics", heuristics_cmd))
+    app.add_handler(CommandHandler("clf", clf_cmd))
+    app.add_handler(CommandHandler("whois", whois_cmd))
+    app.add_handler(CommandHandler("history", history_cmd))
+    app.add_handler(CommandHandler("blockmedia", blockmedia_cmd))
+    app.add_handler(CommandHandler("unblockmedia", unblockmedia_cmd))
 
     # state input (para add/remove palabras)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_state_input), group=0)
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, handle_state_input), group=0)
+
+    # enforcement: mensajes nuevos y editados (texto, captions, encuestas, media)
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGES & ~filters.COMMAND, handle_group_message), group=1)
+
+    if PROFILER:
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = PROFILER.wrap(handler.callback)
+
+    return app
+
+
+async def run_many(tokens: list[str]):
+    """Varios bots en el mismo event loop (mismo proceso, misma DB, mismos caches)."""
+    apps = [build_application(t) for t in tokens]
+    started = []
+    # run_polling maneja SIGTERM/SIGINT para un bot; aquí hay que hacerlo a mano para que
+    # post_shutdown (flush de TRUST/CLASSIFIER/USERS, cierre de la grabación) llegue a correr
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: queda KeyboardInterrupt
+    try:
+        for app in apps:
+            await app.initialize()
+            started.append(app)
+            await app.post_init(app)
+            await app.start()
+            await app.updater.start_polling()
+            print(f"🤖 Bot @{app.bot.username} iniciado...")
+        await stop.wait()
+    finally:
+        for app in reversed(started):
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+            await app.post_shutdown(app)
+            await app.shutdown()
 
-    # enforcement banned words (mensajes normales)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_group_message), group=1)
 
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        return replay_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "evalclf":
+        return evalclf_main(sys.argv[2:])
+    if not TOKENS:
+        raise RuntimeError("Falta TELEGRAM_BOT_TOKEN (o TELEGRAM_BOT_TOKENS). Ponlo en .env o como variable de entorno.")
+
+    init_db()
+    if Image is None:
+        print("ℹ️ Pillow no está instalado: la media bloqueada solo compara copias exactas (pip install Pillow para el hash perceptual).")
+
+    if len(TOKENS) > 1:
+        try:
+            asyncio.run(run_many(TOKENS))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    app = build_application(TOKENS[0])
     print("🤖 Bot iniciado...")
     app.run_polling()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()